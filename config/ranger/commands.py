@@ -11,79 +11,3348 @@ from __future__ import (absolute_import, division, print_function)
 
 # You can import any python module as needed.
 import os
+import queue
 import subprocess
 import atexit
+import errno
+import fcntl
+import hashlib
 import json
+import mimetypes
+import shutil
+import re
+import select
+import socket
+import sqlite3
+import stat
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, as_completed, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from pathlib import Path
 
+import ranger
+
 # You always need to import ranger.api.commands here to get the Command class:
 from ranger.api.commands import Command
+from ranger.config.commands import cd as ranger_cd
+from ranger.container.file import File
+from ranger.core.loader import Loadable
+from ranger.gui.displayable import Displayable
+
+# Global list to track mounted shares
+mounted_shares = []
+
+# Set when ranger exits; long-running background share work stops at the
+# next file or folder once it is set
+share_shutdown = threading.Event()
+
+
+def stop_if_exiting(path):
+    """Raise InterruptedError for path once ranger is exiting."""
+    if share_shutdown.is_set():
+        raise InterruptedError(errno.EINTR, "ranger is exiting", path)
+
+
+class DaemonThreadPool(Executor):
+    """Executor like ThreadPoolExecutor whose workers are daemon threads.
+
+    Python joins ThreadPoolExecutor workers at interpreter shutdown,
+    before atexit handlers run, so a worker blocked on a dead share would
+    hold up ranger's exit and the unmount cleanup with it.  Workers of
+    this pool are never joined at exit; background jobs check
+    share_shutdown to stop early, and anything still stuck in the kernel
+    is abandoned.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix='ranger-smb'):
+        self._max_workers = max_workers
+        self._prefix = thread_name_prefix
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            future = Future()
+            self._queue.put((future, fn, args, kwargs))
+            if not self._idle.acquire(blocking=False) and len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"{self._prefix}_{len(self._threads)}")
+                thread.start()
+                self._threads.append(thread)
+            return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.put(None)  # Pass the shutdown on to the next worker
+                return
+            future, fn, args, kwargs = item
+            del item
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                del future
+            self._idle.release()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item[0].cancel()
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+# Worker pool for mount operations so a slow NAS never blocks the UI thread
+# (or, with daemon workers, ranger's exit).  Only short work runs here:
+# mounts, unmounts, reconnects and calls bounded by the share watchdog.
+share_pool = DaemonThreadPool(8, thread_name_prefix='ranger-smb')
+
+# Long-running share work (warm-up, cache fills, enqueue walks, mirrors,
+# duplicate searches, benchmarks), kept apart so it can never hold up a mount
+job_pool = DaemonThreadPool(4, thread_name_prefix='ranger-smb-job')
+
+# Names of shares with a mount currently in flight
+pending_mounts = set()
+
+# Fallback shares used when smb_shares.json doesn't exist
+DEFAULT_SHARES = {
+    "downloads": {
+        "mount_point": "~/mnt/ArrsDownloadShare",
+        "share_path": "//vcr.int.macapinlac.network/ArrsDownloadShare",
+        "display_name": "ArrsDownloadShare"
+    },
+    "localmedia": {
+        "mount_point": "~/mnt/LocalMediaLibraryShare",
+        "share_path": "//vcr.int.macapinlac.network/LocalMediaLibraryShare",
+        "display_name": "LocalMediaLibraryShare"
+    },
+    "savedmedia": {
+        "mount_point": "~/mnt/SavedMedia",
+        "share_path": "//10.1.0.96/SavedMedia",
+        "display_name": "SavedMedia"
+    }
+}
+
+
+# Tunables, overridable under "settings" in smb_shares.json
+DEFAULT_SETTINGS = {
+    # TCP port and connect timeout (seconds) for the pre-mount reachability probe
+    "probe_port": 445,
+    "probe_timeout": 0.5,
+    # How long (seconds) a failed probe is remembered before retrying the host
+    "probe_failure_ttl": 15,
+    # Overall deadline (seconds) for unmounting every share at exit, and the
+    # extra time given to lazy unmounts of shares that missed it
+    "cleanup_timeout": 10,
+    "lazy_unmount_timeout": 3,
+    # How often (seconds) the background monitor runs its housekeeping jobs
+    "monitor_interval": 30,
+    # Unmount a share after this many seconds with no tab inside it (0 = never);
+    # can be overridden per share
+    "idle_timeout": 0,
+    # :bench_share workload: sequential file size (MiB) and small-file count
+    "bench_size_mb": 64,
+    "bench_small_files": 500,
+    # Route mounts and unmounts through one long-lived root helper
+    # (smb_mount_helper.py) instead of spawning sudo for every operation.
+    # mount_helper_path can point at a root-owned copy of the helper.
+    "mount_helper": False,
+    "mount_helper_path": "",
+    # After mounting, walk this many directory levels in the background to
+    # warm the CIFS caches (0 = off; can be overridden per share), using up
+    # to warmup_workers threads and visiting at most warmup_max_dirs folders
+    "warmup_depth": 0,
+    "warmup_workers": 4,
+    "warmup_max_dirs": 2000,
+    # Deadline (seconds) for filesystem calls under a mounted share; a share
+    # that misses it is marked stalled and re-probed every stall_retry seconds
+    "fs_timeout": 2,
+    "stall_retry": 5,
+    # Lazily unmount and remount tracked shares whose server session went
+    # stale (checked on every monitor tick)
+    "auto_reconnect": True,
+    # Mount a share as soon as a tab enters (or :cd completes into) its
+    # mount point; can be overridden per share
+    "automount": True,
+    # :fetch_from_share default destination, byte-range size (MiB) and threads
+    "fetch_dir": "~/Downloads",
+    "fetch_chunk_mb": 16,
+    "fetch_workers": 4,
+    # Transfer queue: copies running at once per share, and the bandwidth
+    # (MiB/s, 0 = no limit) all queued copies share
+    "transfer_share_concurrency": 2,
+    "transfer_bandwidth_mb": 0,
+    # Check every queued copy against its source by checksum (as with -v),
+    # hashing verify_block_mb segments of both files on verify_workers threads
+    "transfer_verify": False,
+    "verify_block_mb": 8,
+    "verify_workers": 4,
+    # Record a SHA-256 of every file :mirror_share copies (for :mirror_share -c)
+    "mirror_hash": False,
+    # :mirror_share lists the source and copies files on mirror_workers threads
+    "mirror_workers": 4,
+    # :share_dupes ignores files smaller than dupes_min_mb and hashes on
+    # dupes_workers threads
+    "dupes_min_mb": 1,
+    "dupes_workers": 4,
+    # Local copies of share files for previews and viewers: total budget
+    # (MiB, 0 = off) and the largest file worth caching (MiB)
+    "content_cache_mb": 512,
+    "content_cache_max_file_mb": 32,
+    # Seconds the status bar's free space of a share is reused before it is
+    # refreshed in the background
+    "free_space_ttl": 30,
+    # Keep a filename index of each mounted share for :share_find (can be
+    # overridden per share), refreshed every index_interval seconds
+    # (0 = only after mounting) by index_workers threads
+    "index": True,
+    "index_interval": 900,
+    "index_workers": 4,
+}
+
+
+# Built-in CIFS option profiles; smb_shares.json can add or override them under
+# "profiles" and pick one per share with "profile"
+DEFAULT_PROFILES = {
+    # Large sequential reads: big I/O sizes, relaxed attribute caching
+    "bulk-media": {"rsize": 4194304, "wsize": 4194304, "cache": "loose", "actimeo": 60},
+    # Lots of small files changing underneath us: short attribute cache and a
+    # dedicated connection so browsing doesn't queue behind other shares
+    "metadata-heavy": {"cache": "strict", "actimeo": 1, "nosharesock": True},
+}
+
+def _int_between(low, high, step=1):
+    return lambda v: (isinstance(v, int) and not isinstance(v, bool)
+                      and low <= v <= high and v % step == 0)
+
+
+def _flag(v):
+    return isinstance(v, bool)
+
+
+# Mount options a profile may set, with a validator for each value
+CIFS_OPTION_RULES = {
+    "rsize": _int_between(1024, 16777216, 1024),
+    "wsize": _int_between(1024, 16777216, 1024),
+    "cache": lambda v: v in ("strict", "loose", "none", "ro", "singleclient"),
+    "actimeo": _int_between(0, 86400),
+    "acregmax": _int_between(0, 86400),
+    "acdirmax": _int_between(0, 86400),
+    "echo_interval": _int_between(1, 600),
+    "vers": lambda v: v in ("1.0", "2.0", "2.1", "3", "3.0", "3.02", "3.1.1", "default"),
+    "nosharesock": _flag,
+    "noserverino": _flag,
+    "nobrl": _flag,
+    "hard": _flag,
+    "soft": _flag,
+}
+
+# Options every share is mounted with, ahead of its profile
+BASE_MOUNT_OPTIONS = "rw,guest"
+
+
+def cifs_mount_options(share, profiles):
+    """Build the -o string for a share from its profile and per-share options.
+
+    Returns (profile_name, options).  Raises ValueError naming the share
+    for an unknown profile or an option that isn't in CIFS_OPTION_RULES.
+    """
+    profile_name = share.get('profile')
+    if profile_name is not None and profile_name not in profiles:
+        raise ValueError(f"{share['display_name']}: unknown profile {profile_name!r}")
+
+    options = dict(profiles.get(profile_name, {}))
+    options.update(share.get('options', {}))
+
+    parts = [BASE_MOUNT_OPTIONS]
+    for key, value in options.items():
+        rule = CIFS_OPTION_RULES.get(key)
+        if rule is None:
+            raise ValueError(f"{share['display_name']}: unsupported mount option {key!r}")
+        if not rule(value):
+            raise ValueError(f"{share['display_name']}: invalid value {value!r} for {key}")
+        if value is True:
+            parts.append(key)
+        elif value is not False:
+            parts.append(f"{key}={value}")
+    return profile_name, ','.join(parts)
+
+
+class ShareRegistry(Mapping):
+    """Share definitions from smb_shares.json, loaded on first use.
+
+    Behaves like a read-only dict of share name -> entry.  Every access
+    revalidates the file with a single stat (mtime, inode, size) and only
+    re-parses it when that changes, so edits take effect without
+    restarting ranger.  Entries are cached with mount_point already run
+    through expanduser.  If an edit leaves the file unreadable, the last
+    good definitions stay in use and the problem is kept in self.error.
+
+    The hooks ranger runs on every redraw and cd use peek() instead,
+    which never touches the file, so ranger's startup doesn't either.
+    """
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.error = None
+        self._lock = threading.Lock()
+        self._signature = None
+        self._shares = {}
+        self._groups = {}
+        self._settings = dict(DEFAULT_SETTINGS)
+        self._profiles = dict(DEFAULT_PROFILES)
+
+    def _resolve(self, config):
+        shares = {}
+        for name, entry in config.get("shares", {}).items():
+            entry = dict(entry)
+            entry['name'] = name.lower()
+            entry['mount_point'] = os.path.expanduser(entry['mount_point'])
+            shares[name.lower()] = entry
+        groups = {}
+        for name, members in config.get("groups", {}).items():
+            groups[name.lower()] = [member.lower() for member in members]
+        settings = dict(DEFAULT_SETTINGS)
+        settings.update(config.get("settings", {}))
+        profiles = dict(DEFAULT_PROFILES)
+        profiles.update(config.get("profiles", {}))
+        return shares, groups, settings, profiles
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.config_path)
+            signature = (st.st_mtime_ns, st.st_ino, st.st_size)
+        except OSError:
+            signature = 'missing'
+        if signature == self._signature:
+            return
+
+        try:
+            if signature == 'missing':
+                config = {"shares": DEFAULT_SHARES}
+            else:
+                with open(self.config_path, 'r') as f:
+                    config = json.load(f)
+            shares, groups, settings, profiles = self._resolve(config)
+        except (json.JSONDecodeError, IOError, KeyError, TypeError, AttributeError) as e:
+            self.error = f"Error loading SMB shares config: {e}"
+        else:
+            self._shares, self._groups, self._settings, self._profiles = shares, groups, settings, profiles
+            self.error = None
+        self._signature = signature
+
+    def load(self):
+        """Read the file if it hasn't been read yet or has changed since."""
+        with self._lock:
+            self._refresh()
+
+    def _current(self):
+        with self._lock:
+            self._refresh()
+            return self._shares
+
+    @property
+    def loaded(self):
+        """Whether the file has been read yet."""
+        return self._signature is not None
+
+    def peek(self):
+        """(shares, settings) as last loaded, without stat-ing the file.
+
+        Before the first load that is no shares and DEFAULT_SETTINGS.
+        """
+        with self._lock:
+            return self._shares, self._settings
+
+    def __getitem__(self, name):
+        return self._current()[name]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+    @property
+    def groups(self):
+        """Named groups of share names that are mounted together."""
+        with self._lock:
+            self._refresh()
+            return self._groups
+
+    @property
+    def settings(self):
+        """Global tunables, DEFAULT_SETTINGS overlaid with the config's."""
+        with self._lock:
+            self._refresh()
+            return self._settings
+
+    @property
+    def profiles(self):
+        """CIFS option profiles, DEFAULT_PROFILES overlaid with the config's."""
+        with self._lock:
+            self._refresh()
+            return self._profiles
+
+
+class MountTable(object):
+    """In-process view of the kernel mount table.
+
+    Parsed from /proc/self/mountinfo and re-read only after the kernel
+    flags a change (POLLPRI on the open file), so "is it mounted?" is a
+    dict lookup that never stats a possibly hung remote filesystem.
+    Falls back to os.path.ismount where mountinfo isn't available.
+    """
+
+    mountinfo_path = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fd = None
+        self._poller = None
+        self._mounts = {}
+        self.available = True
+
+    @staticmethod
+    def _unescape(field):
+        # mountinfo escapes space, tab, newline and backslash as octal
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+    def _parse(self, data):
+        mounts = {}
+        for line in data.splitlines():
+            fields = line.split()
+            try:
+                separator = fields.index('-')
+                mount_point = self._unescape(fields[4])
+                mounts[mount_point] = {
+                    'mount_point': mount_point,
+                    'fstype': fields[separator + 1],
+                    'source': self._unescape(fields[separator + 2]),
+                    'options': fields[5] + ',' + fields[separator + 3],
+                }
+            except (ValueError, IndexError):
+                continue
+        return mounts
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self._mounts = self._parse(b''.join(chunks).decode('utf-8', 'surrogateescape'))
+
+    def _sync(self):
+        """Open mountinfo on first use, then re-read it only after a change."""
+        if self._fd is None:
+            try:
+                self._fd = os.open(self.mountinfo_path, os.O_RDONLY)
+            except OSError:
+                self.available = False
+                return
+            self._poller = select.poll()
+            self._poller.register(self._fd, select.POLLPRI | select.POLLERR)
+            self._read()
+        elif self._poller.poll(0):
+            # Polling acknowledges the event, so the next change fires again
+            self._read()
+
+    @staticmethod
+    def normalize(path):
+        """Canonical form of a mount point without touching the mount itself.
+
+        Only the parent directory is resolved, since stat-ing the mount point
+        of a dead server is exactly what this table exists to avoid.
+        """
+        path = os.path.normpath(os.path.expanduser(path))
+        return os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+
+    def get(self, path):
+        """Return the mountinfo entry for path, or None if nothing is mounted there."""
+        with self._lock:
+            if self.available:
+                self._sync()
+            if self.available:
+                return self._mounts.get(self.normalize(path))
+        if os.path.ismount(path):
+            return {'mount_point': path, 'fstype': None, 'source': None, 'options': ''}
+        return None
+
+    def is_mounted(self, path):
+        return self.get(path) is not None
+
+    def has_share_near(self, path):
+        """Whether a CIFS mount holds path or sits directly inside it."""
+        path = os.path.normpath(path)
+        with self._lock:
+            if not self.available:
+                return False
+            self._sync()
+            return any(entry['fstype'] in ('cifs', 'smb3')
+                       and (path_under(path, mount_point) or os.path.dirname(mount_point) == path)
+                       for mount_point, entry in self._mounts.items())
+
+
+# Single mount table shared by all share commands
+mount_table = MountTable()
+
+
+def share_datadir():
+    """Ranger's data directory, also usable where no fm is at hand (atexit)."""
+    args = getattr(ranger, 'args', None)
+    if args is not None and getattr(args, 'datadir', None):
+        return args.datadir
+    return os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'),
+                        'ranger')
+
+
+def process_start_time(pid):
+    """Start time of pid in clock ticks since boot, or None if it isn't running.
+
+    Used together with the pid so a recycled pid isn't mistaken for a
+    ranger session that has since exited.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            # The command name may contain spaces; fields resume after its ')'
+            return int(f.read().rsplit(b')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return 0
+
+
+class MountRefs(object):
+    """Reference counts of ranger sessions using each mount point.
+
+    Kept in smb_mounts.json under ranger's data directory so that several
+    ranger instances (one per tmux window, say) share one view.  Every
+    read-modify-write holds an flock on smb_mounts.lock, and sessions that
+    have exited without cleaning up are pruned on each access.  Only the
+    session that drops the last reference should unmount.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._start_time = None
+
+    @contextmanager
+    def _state(self):
+        datadir = share_datadir()
+        os.makedirs(datadir, exist_ok=True)
+        state_path = os.path.join(datadir, 'smb_mounts.json')
+        with open(os.path.join(datadir, 'smb_mounts.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(state_path, 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+
+            # Drop sessions that are no longer running
+            for mount_point in list(state):
+                state[mount_point] = [user for user in state[mount_point]
+                                      if process_start_time(user['pid']) == user['started']]
+                if not state[mount_point]:
+                    del state[mount_point]
+
+            yield state
+
+            tmp_path = state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, state_path)
+
+    def _me(self):
+        if self._start_time is None:
+            self._start_time = process_start_time(self.pid)
+        return {'pid': self.pid, 'started': self._start_time}
+
+    def acquire(self, mount_point):
+        """Register this session as a user of mount_point."""
+        me = self._me()
+        with self._state() as state:
+            users = state.setdefault(mount_point, [])
+            if me not in users:
+                users.append(me)
+
+    def release(self, mount_point):
+        """Drop this session's reference; return how many other sessions remain."""
+        me = self._me()
+        with self._state() as state:
+            users = [user for user in state.get(mount_point, []) if user != me]
+            if users:
+                state[mount_point] = users
+            else:
+                state.pop(mount_point, None)
+            return len(users)
+
+    def others(self, mount_point):
+        """Number of other live sessions using mount_point."""
+        me = self._me()
+        with self._state() as state:
+            return len([user for user in state.get(mount_point, []) if user != me])
+
+
+# Reference counts shared with other ranger sessions
+mount_refs = MountRefs()
+
+
+class PhaseTimer(object):
+    """Collects the duration of each phase of one share operation."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name + '_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 2)
+
+
+class ShareTelemetry(object):
+    """Appends one JSON line per share operation to smb_events.jsonl.
+
+    Each event has the share name, operation, per-phase timings in ms,
+    the exit code and an error class (None on success).  Written from
+    worker threads, so appends are serialized with a lock.
+    """
+
+    filename = 'smb_events.jsonl'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def path(self):
+        return os.path.join(share_datadir(), self.filename)
+
+    def record(self, op, share, timer, exit_code=None, error_class=None):
+        event = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'op': op,
+            'share': share,
+            'total_ms': timer.total_ms(),
+            'exit_code': exit_code,
+            'error_class': error_class,
+        }
+        event.update(timer.phases)
+        try:
+            with self._lock:
+                os.makedirs(share_datadir(), exist_ok=True)
+                with open(self.path(), 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+        except OSError:
+            pass  # Telemetry must never break a mount
+
+    def load(self):
+        events = []
+        try:
+            with open(self.path(), 'r') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return events
+
+
+# Timing log for mounts, unmounts and probes
+share_telemetry = ShareTelemetry()
+
+
+# Share definitions, parsed lazily on the first share command
+SHARES = ShareRegistry(Path(__file__).parent / "smb_shares.json")
+
+
+class MountHelper(object):
+    """Client for the optional privileged mount helper.
+
+    The helper (smb_mount_helper.py) is started with sudo the first time
+    it's needed and then kept for the whole session.  Requests are JSON
+    lines tagged with an id, so concurrent mounts from the worker pool are
+    pipelined over the one socket; a reader thread matches responses back
+    to their futures.  If the helper can't be started, the session falls
+    back to plain sudo and doesn't try again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._sock = None
+        self._failed = False
+        self._next_id = 0
+        self._pending = {}
+
+    def enabled(self):
+        """True once the helper is connected, starting it if configured to."""
+        with self._lock:
+            if self._sock is not None:
+                return True
+            if self._failed or not SHARES.settings['mount_helper']:
+                return False
+            try:
+                self._start(SHARES.settings)
+            except OSError:
+                self._failed = True
+                return False
+            return True
+
+    # Where the helper listens; it picks the name itself from the sudo caller's uid
+    socket_dir = '/run/ranger-smb'
+
+    def _start(self, settings):
+        helper = settings['mount_helper_path'] or str(Path(__file__).parent / "smb_mount_helper.py")
+        socket_path = os.path.join(self.socket_dir, f"{os.getuid()}.sock")
+        # Run by its own path (it is executable), so the sudoers rule names
+        # exactly that command; -n: never prompt from inside the ranger UI
+        process = subprocess.Popen(
+            ['sudo', '-n', helper],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                sock.connect(socket_path)
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    sock.close()
+                    if process.poll() is None:
+                        process.kill()
+                    raise OSError("mount helper did not start")
+                time.sleep(0.05)
+
+        self._sock = sock
+        threading.Thread(target=self._read_responses, args=(sock,),
+                         name='ranger-smb-helper', daemon=True).start()
+
+    def _read_responses(self, sock):
+        with sock.makefile('rb') as reader:
+            for line in reader:
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    continue
+                future = self._pending.pop(response.get('id'), None)
+                if future is not None:
+                    future.set_result(response)
+        # The helper went away; fail whatever is still waiting
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+                self._failed = True
+        for request_id in list(self._pending):
+            future = self._pending.pop(request_id, None)
+            if future is not None:
+                future.set_exception(OSError("mount helper exited"))
+
+    def run(self, argv, timeout, timer):
+        """Run argv as root through the helper, like subprocess.run.
+
+        Raises subprocess.TimeoutExpired on timeout and OSError if the
+        helper is gone.
+        """
+        future = Future()
+        with self._write_lock, timer.phase('spawn'):
+            sock = self._sock
+            if sock is None:
+                raise OSError("mount helper is not running")
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = future
+            request = {'id': request_id, 'argv': argv, 'timeout': timeout}
+            sock.sendall((json.dumps(request) + '\n').encode())
+
+        try:
+            # A little slack for the round trip on top of the helper's own timeout
+            with timer.phase(argv[0]):
+                response = future.result(timeout=timeout + 2)
+        except FutureTimeoutError:
+            self._pending.pop(request_id, None)
+            raise subprocess.TimeoutExpired(argv, timeout)
+        if response.get('error') == 'timeout':
+            raise subprocess.TimeoutExpired(argv, timeout)
+        return subprocess.CompletedProcess(argv, response.get('returncode', 1),
+                                           stdout='', stderr=response.get('stderr', ''))
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+
+# Session-wide connection to the privileged helper, if enabled.  Registered
+# before the share cleanup, so it is closed (and the helper exits) after it.
+mount_helper = MountHelper()
+atexit.register(mount_helper.close)
+
+
+def run_privileged(argv, timeout, timer=None):
+    """Run a mount or umount command as root and return a CompletedProcess.
+
+    argv is the command without sudo.  It goes through the mount helper
+    when that's enabled, otherwise through a fresh sudo -n: a password
+    prompt would fight curses for the terminal, so a sudo that wants a
+    password fails with an explanation in stderr instead.  Raises
+    subprocess.TimeoutExpired like subprocess.run does.  With a timer,
+    the time to hand the command off is recorded as the "spawn" phase and
+    the wait for the kernel as a phase named after the command.
+    """
+    timer = timer or PhaseTimer()
+    if mount_helper.enabled():
+        try:
+            return mount_helper.run(argv, timeout, timer)
+        except OSError:
+            pass  # Helper died; this call falls back to sudo
+
+    with timer.phase('spawn'):
+        process = subprocess.Popen(['sudo', '-n'] + argv, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True)
+    with process, timer.phase(argv[0]):
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+    if process.returncode != 0 and 'password is required' in stderr:
+        stderr = (f"sudo needs a password for {argv[0]}, which ranger can't ask for; "
+                  "allow it without one (NOPASSWD) in sudoers or set up the mount helper")
+    return subprocess.CompletedProcess(argv, process.returncode, stdout, stderr)
+
+
+def run_umount(mount_point, lazy=False, timeout=30):
+    """Run umount (umount -l if lazy) as root and return (success, error)."""
+    command = ['umount', '-l', mount_point] if lazy else ['umount', mount_point]
+    share_name, _ = share_for_path(mount_point)
+    op = 'lazy_unmount' if lazy else 'unmount'
+    timer = PhaseTimer()
+    try:
+        result = run_privileged(command, timeout, timer)
+    except subprocess.TimeoutExpired:
+        share_telemetry.record(op, share_name or mount_point, timer, error_class='timeout')
+        return False, f"timed out after {timeout:.1f}s"
+    except Exception as e:
+        share_telemetry.record(op, share_name or mount_point, timer, error_class=type(e).__name__)
+        return False, str(e)
+    share_telemetry.record(op, share_name or mount_point, timer, result.returncode,
+                           None if result.returncode == 0 else 'exit_status')
+    return result.returncode == 0, result.stderr.strip()
+
+
+def umount_all(mount_points, timeout, lazy=False):
+    """Unmount mount_points concurrently and return {mount_point: (success, error)}.
+
+    Every unmount shares one deadline, so the call returns within about
+    timeout seconds however many shares there are.  Mount points still
+    running at the deadline are missing from the result.
+    """
+    results = {}
+
+    def worker(mount_point):
+        results[mount_point] = run_umount(mount_point, lazy=lazy, timeout=timeout)
+
+    # Daemon threads so a wedged umount can never hold up interpreter exit
+    threads = [threading.Thread(target=worker, args=(mount_point,), daemon=True)
+               for mount_point in mount_points]
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()) + 0.5)
+    return dict(results)
+
+
+def release_mount_ref(mount_point, report):
+    """Drop this session's reference to mount_point, passing any error to report."""
+    try:
+        mount_refs.release(mount_point)
+    except OSError as e:
+        report(f"Could not update shared mount registry: {e}")
+
+
+def cleanup_mounted_shares():
+    """Unmount all shares that were mounted during this Ranger session
+
+    All shares are unmounted in parallel under one deadline
+    (cleanup_timeout); any that fail or don't respond in time are
+    detached with a lazy unmount, so exit time stays bounded.
+    """
+    shares = [s for s in mounted_shares if mount_table.is_mounted(s['mount_point'])]
+
+    # Leave shares that another ranger session is still using
+    still_used = []
+    for share_info in list(shares):
+        try:
+            if mount_refs.others(share_info['mount_point']):
+                still_used.append(share_info)
+        except OSError as e:
+            print(f"Could not read shared mount registry: {e}")
+    for share_info in still_used:
+        shares.remove(share_info)
+        release_mount_ref(share_info['mount_point'], print)
+        print(f"Leaving {share_info['display_name']} mounted for other ranger sessions")
+    if not shares:
+        return
+
+    settings = SHARES.settings
+    results = umount_all([s['mount_point'] for s in shares], settings['cleanup_timeout'])
+
+    stuck = [s['mount_point'] for s in shares
+             if not results.get(s['mount_point'], (False, None))[0]]
+    if stuck:
+        results.update(umount_all(stuck, settings['lazy_unmount_timeout'], lazy=True))
+
+    for share_info in shares:
+        mount_point = share_info['mount_point']
+        display_name = share_info['display_name']
+        success, error = results.get(mount_point, (False, "no response"))
+        if not success:
+            print(f"Failed to unmount {display_name}: {error}")
+            continue
+
+        detached = " (lazy)" if mount_point in stuck else ""
+        print(f"Unmounted {display_name} at {mount_point}{detached}")
+        release_mount_ref(mount_point, print)
+
+        # Try to remove the mount point directory if it's empty
+        try:
+            os.rmdir(mount_point)
+            print(f"Removed mount point directory: {mount_point}")
+        except OSError as e:
+            # Directory not empty or other error - just log it
+            print(f"Could not remove mount point directory {mount_point}: {e}")
+
+# Register cleanup function to run when Python exits
+atexit.register(cleanup_mounted_shares)
+# Registered after the cleanup so that it runs before it: background share
+# work winds down (and lets go of open files) while the unmounts start
+atexit.register(share_shutdown.set)
+
+
+# Hosts that recently failed the reachability probe: (host, port) -> (expiry, reason)
+unreachable_hosts = {}
+unreachable_hosts_lock = threading.Lock()
+
+
+def share_host(share_path):
+    """Extract the server name from a //server/share path."""
+    return share_path.replace('\\', '/').lstrip('/').split('/', 1)[0]
+
+
+def probe_host(host, port=445, timeout=0.5, failure_ttl=15):
+    """Check that host accepts TCP connections on port.
+
+    Returns None if it does, otherwise a short reason.  Failures are
+    remembered for failure_ttl seconds so repeated attempts against a dead
+    server fail immediately instead of waiting out the timeout again.
+    """
+    key = (host, port)
+    now = time.monotonic()
+    with unreachable_hosts_lock:
+        cached = unreachable_hosts.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            pass
+    except socket.timeout:
+        reason = f"{host}:{port} did not answer within {timeout}s"
+    except OSError as e:
+        reason = f"{host}:{port} unreachable ({e.strerror or e})"
+    else:
+        with unreachable_hosts_lock:
+            unreachable_hosts.pop(key, None)
+        return None
+
+    with unreachable_hosts_lock:
+        unreachable_hosts[key] = (time.monotonic() + failure_ttl, reason)
+    return reason
+
+
+def run_cifs_mount(share, settings):
+    """Probe the server, run the CIFS mount and return (success, message).
+
+    Runs on a worker thread, so it must not touch the file manager.
+    """
+    display_name = share['display_name']
+    share_path = share['share_path']
+    mount_point = share['mount_point']
+    mount_options = share.get('mount_options', BASE_MOUNT_OPTIONS)
+    name = share.get('name', display_name)
+    timer = PhaseTimer()
+
+    # Fail fast on an unreachable host instead of waiting out the mount timeout
+    with timer.phase('probe'):
+        unreachable = probe_host(share_host(share_path),
+                                 port=share.get('probe_port', settings['probe_port']),
+                                 timeout=share.get('probe_timeout', settings['probe_timeout']),
+                                 failure_ttl=settings['probe_failure_ttl'])
+    if unreachable:
+        share_telemetry.record('mount', name, timer, error_class='unreachable')
+        return False, f"Cannot reach {display_name}: {unreachable}"
+
+    try:
+        result = run_privileged([
+            'mount', '-t', 'cifs',
+            '-o', mount_options,
+            share_path, mount_point
+        ], timeout=30, timer=timer)
+    except subprocess.TimeoutExpired:
+        share_telemetry.record('mount', name, timer, error_class='timeout')
+        return False, f"Mount operation timed out for {display_name}"
+    except FileNotFoundError:
+        share_telemetry.record('mount', name, timer, error_class='not_found')
+        return False, "mount command not found. Please install cifs-utils"
+    except Exception as e:
+        share_telemetry.record('mount', name, timer, error_class=type(e).__name__)
+        return False, f"Error mounting {display_name}: {e}"
+
+    if result.returncode != 0:
+        share_telemetry.record('mount', name, timer, result.returncode, 'exit_status')
+        return False, f"Failed to mount {display_name}: {result.stderr}"
+
+    # Time the first listing of the new mount, which also warms it up
+    try:
+        with timer.phase('readdir'), os.scandir(mount_point) as entries:
+            for _ in entries:
+                pass
+    except OSError:
+        pass
+    share_telemetry.record('mount', name, timer, result.returncode)
+    return True, f"Successfully mounted {display_name}"
+
+
+class ShareTask(Loadable):
+    """Loader item that waits for background share operations.
+
+    Ranger's loader drives generate() from the UI loop, so on_done runs on
+    the UI thread and may safely notify or change directories.  The task
+    also shows up in the status bar throbber and the task view (w).
+    on_done receives the results in the same order as the futures.
+    on_result, if given, is called with (index, result) for each future
+    as soon as it finishes.
+    """
+
+    def __init__(self, futures, descr, on_done, on_result=None):
+        self.futures = list(futures)
+        self.on_done = on_done
+        self.on_result = on_result
+        Loadable.__init__(self, self.generate(), descr)
+
+    def generate(self):
+        pending = set(self.futures)
+        # Short waits keep the UI responsive while the workers run
+        while pending:
+            done, pending = wait(pending, timeout=0.01)
+            if self.on_result is not None:
+                for future in done:
+                    self.on_result(self.futures.index(future), future.result())
+            self.percent = 100 * (len(self.futures) - len(pending)) / len(self.futures)
+            yield
+        self.on_done([future.result() for future in self.futures])
+
+
+def path_under(path, root):
+    """True if path is root or lies somewhere below it."""
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+
+class UIPump(Displayable):
+    """Invisible widget that runs queued callbacks on the UI thread.
+
+    Ranger pokes every widget once per main-loop iteration, which happens
+    at least every idle_delay even without input, so background threads
+    can hand work back to the UI without touching it directly.
+    """
+
+    def __init__(self, callbacks):
+        Displayable.__init__(self, None)
+        self.visible = False
+        self.callbacks = callbacks
+
+    def poke(self):
+        while self.callbacks:
+            callback = self.callbacks.popleft()
+            try:
+                callback()
+            except Exception as e:
+                self.fm.notify(f"Share monitor callback failed: {e}", bad=True)
+
+    def draw(self):
+        pass
+
+
+class ShareMonitor(object):
+    """Background housekeeping for mounted shares.
+
+    Started by the first mount or share command.  A daemon thread wakes every
+    monitor_interval seconds and runs the registered jobs; jobs must not
+    touch the file manager and hand anything UI-related to post().  The
+    monitor also keeps a snapshot of every tab's path, refreshed from
+    ranger's cd and tab signals, so jobs can see where the user is
+    without reading ranger state off the UI thread.
+    """
+
+    def __init__(self):
+        self.fm = None
+        self.jobs = []
+        self.callbacks = deque()
+        self.tab_paths = ()
+        self.current_path = None
+        self.last_active = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, fm):
+        if self._thread is not None:
+            return
+        self.fm = fm
+        fm.ui.add_child(UIPump(self.callbacks))
+        fm.signal_bind('cd', self._update_tab_paths)
+        fm.signal_bind('tab.layoutchange', self._update_tab_paths)
+        fm.signal_bind('tab.change', self._update_tab_paths)
+        self._update_tab_paths()
+        self._thread = threading.Thread(target=self._run, name='ranger-smb-monitor', daemon=True)
+        self._thread.start()
+
+    def add_job(self, job):
+        """Run job(monitor, now) on every monitor tick."""
+        self.jobs.append(job)
+
+    def post(self, callback):
+        """Queue callback to run on the UI thread (safe from any thread)."""
+        self.callbacks.append(callback)
+
+    def touch(self, mount_point):
+        """Mark a share as in use right now."""
+        self.last_active[mount_point] = time.monotonic()
+
+    def _update_tab_paths(self, signal=None):
+        # Tuple assignment is atomic, so the monitor thread never sees a partial update
+        self.tab_paths = tuple(tab.path for tab in self.fm.tabs.values() if tab.path)
+        self.current_path = self.fm.thistab.path
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(SHARES.settings['monitor_interval'])
+            self._wakeup.clear()
+            now = time.monotonic()
+            for job in list(self.jobs):
+                try:
+                    job(self, now)
+                except Exception as e:
+                    message = f"Share monitor job {job.__name__} failed: {e}"
+                    self.post(lambda message=message: self.fm.notify(message, bad=True))
+
+
+# Single monitor shared by all share commands
+share_monitor = ShareMonitor()
+
+
+# Mount points with an unmount in flight, idle or from :unmount_share
+idle_unmounts = set()
+
+# Number of background jobs (mirrors, indexing, ...) using each mount point
+share_users = {}
+share_users_lock = threading.Lock()
+
+
+@contextmanager
+def share_in_use(*paths):
+    """Keep the shares holding paths from being unmounted as idle while the block runs."""
+    mount_points = set()
+    for path in paths:
+        _, share = share_for_path(path)
+        if share is not None:
+            mount_points.add(share['mount_point'])
+    with share_users_lock:
+        for mount_point in mount_points:
+            share_users[mount_point] = share_users.get(mount_point, 0) + 1
+    try:
+        yield
+    finally:
+        with share_users_lock:
+            for mount_point in mount_points:
+                share_users[mount_point] -= 1
+                if not share_users[mount_point]:
+                    del share_users[mount_point]
+
+
+def unmount_idle_shares(monitor, now):
+    """Monitor job: unmount shares no tab has visited for idle_timeout seconds."""
+    settings = SHARES.settings
+    for share in list(mounted_shares):
+        mount_point = share['mount_point']
+        timeout = share.get('idle_timeout', settings['idle_timeout'])
+        if not timeout or mount_point in idle_unmounts:
+            continue
+        if any(path_under(path, mount_point) for path in monitor.tab_paths):
+            monitor.touch(mount_point)
+            continue
+        # Background work counts as use only while it runs, so the share
+        # goes once it ends if no tab has been there for idle_timeout
+        if share_users.get(mount_point) or transfer_queue.has_work(share['name']):
+            continue
+        if now - monitor.last_active.setdefault(mount_point, now) < timeout:
+            continue
+
+        try:
+            others = mount_refs.others(mount_point)
+        except OSError:
+            continue  # Can't tell who else uses it; look again next tick
+        idle_unmounts.add(mount_point)
+        if others:
+            # Another session still uses it; just stop tracking it here
+            monitor.post(lambda share=share: finish_idle_unmount(monitor.fm, share, True, None,
+                                                                 released=True))
+            continue
+        future = share_pool.submit(run_umount, mount_point)
+
+        def on_done(future, share=share):
+            monitor.post(lambda: finish_idle_unmount(monitor.fm, share, *future.result()))
+
+        future.add_done_callback(on_done)
+
+
+def finish_idle_unmount(fm, share, success, error, released=False):
+    """UI-thread half of an idle unmount."""
+    mount_point = share['mount_point']
+    idle_unmounts.discard(mount_point)
+    if not success:
+        fm.notify(f"Could not unmount idle share {share['display_name']}: {error}", bad=True)
+        return
+    mounted_shares[:] = [s for s in mounted_shares if s['mount_point'] != mount_point]
+    share_monitor.last_active.pop(mount_point, None)
+    # Drop this session's reference only once the share has really been let go
+    release_mount_ref(mount_point, lambda message: fm.notify(message, bad=True))
+    if released:
+        fm.notify(f"Released idle share {share['display_name']} (still used by other sessions)")
+        return
+    fm.notify(f"Unmounted idle share {share['display_name']}")
+    try:
+        os.rmdir(mount_point)
+    except OSError:
+        pass
+
+
+share_monitor.add_job(unmount_idle_shares)
+
+
+def share_for_path(path, shares=None):
+    """Return (name, entry) of the configured share whose mount point holds path.
+
+    shares defaults to SHARES; the redraw and cd hooks pass hooked_shares(path).
+    """
+    for name, share in (SHARES if shares is None else shares).items():
+        if path_under(path, share['mount_point']):
+            return name, share
+    return None, None
+
+
+class ShareStalled(OSError):
+    """A mounted share did not answer a filesystem call within fs_timeout.
+
+    fresh is True only for the call that noticed the stall, so callers
+    polled every UI tick can report it once.
+    """
+
+    fresh = False
+
+
+class ShareWatchdog(object):
+    """Deadline-bounded filesystem access for paths under mounted shares.
+
+    When a CIFS server goes away, stat, listdir and rmdir on the mount
+    block in uninterruptible sleep, and on the UI thread that freezes
+    ranger.  Calls on share paths therefore run in a daemon thread and
+    the caller waits at most fs_timeout seconds.  A share that misses the
+    deadline is marked stalled: further calls fail at once with
+    ShareStalled, and a statvfs of the mount point is retried in the
+    background every stall_retry seconds until the server answers.
+    Threads stuck in the kernel are abandoned.  Paths outside mounted
+    shares are called directly.
+    """
+
+    # How long (seconds) a successful liveness check is trusted by check()
+    check_ttl = 1.0
+
+    def __init__(self):
+        self.stalled = {}
+        self._probing = set()
+        self._last_probe = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def shares_for(self, path):
+        """Mounted shares that a filesystem call on path may touch.
+
+        That is the share holding path, plus any share mounted directly
+        inside it, since listing a directory stats its mount points too.
+        """
+        path = os.path.normpath(path)
+        return [share for share in hooked_shares(path).values()
+                if (path_under(path, share['mount_point'])
+                    or os.path.dirname(share['mount_point']) == path)
+                and mount_table.is_mounted(share['mount_point'])]
+
+    def call(self, path, func, *args):
+        """Run func(*args) with a deadline if path lies under a mounted share."""
+        shares = self.shares_for(path)
+        if not shares:
+            return func(*args)
+        for share in shares:
+            self._raise_if_stalled(share, path)
+
+        outcome = {}
+        done = threading.Event()
+
+        def run():
+            try:
+                outcome['value'] = func(*args)
+            except BaseException as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        threading.Thread(target=run, name='ranger-smb-fs', daemon=True).start()
+        if not done.wait(SHARES.peek()[1]['fs_timeout']):
+            # Blame the innermost share; that's where the call was headed
+            share = max(shares, key=lambda s: len(s['mount_point']))
+            with self._lock:
+                self.stalled.setdefault(share['mount_point'], time.monotonic())
+            error = self._stalled_error(share, path)
+            error.fresh = True
+            raise error
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['value']
+
+    def check(self, path):
+        """Raise ShareStalled unless every share path touches answers statvfs in time.
+
+        Successful checks are trusted for check_ttl seconds, so this is
+        cheap enough to run on every redraw.
+        """
+        now = time.monotonic()
+        for share in self.shares_for(path):
+            mount_point = share['mount_point']
+            self._raise_if_stalled(share, path)
+            if self._checked.get(mount_point, 0) > now:
+                continue
+            try:
+                self.call(mount_point, os.statvfs, mount_point)
+            except ShareStalled:
+                raise
+            except OSError:
+                # The server answered, just not happily; let the caller see that
+                pass
+            self._checked[mount_point] = now + self.check_ttl
+
+    def _stalled_error(self, share, path):
+        return ShareStalled(errno.ETIMEDOUT, f"{share['display_name']} is not responding", path)
+
+    def _raise_if_stalled(self, share, path):
+        mount_point = share['mount_point']
+        if mount_point in self.stalled:
+            self._probe(share)
+            raise self._stalled_error(share, path)
+
+    def _probe(self, share):
+        """Start a background statvfs of a stalled share, at most every stall_retry seconds."""
+        mount_point = share['mount_point']
+        now = time.monotonic()
+        with self._lock:
+            if (mount_point in self._probing
+                    or now - self._last_probe.get(mount_point, 0) < SHARES.peek()[1]['stall_retry']):
+                return
+            self._probing.add(mount_point)
+            self._last_probe[mount_point] = now
+
+        def run():
+            try:
+                os.statvfs(mount_point)
+            except OSError:
+                pass
+            with self._lock:
+                self._probing.discard(mount_point)
+                self.stalled.pop(mount_point, None)
+                self._checked.pop(mount_point, None)
+            if share_monitor.fm is not None:
+                share_monitor.post(lambda: share_monitor.fm.notify(
+                    f"{share['display_name']} is responding again"))
+
+        threading.Thread(target=run, name='ranger-smb-probe', daemon=True).start()
+
+
+# Single watchdog shared by all share commands and ranger's own directory loading
+share_watchdog = ShareWatchdog()
+
+
+def reprobe_stalled_shares(monitor, now):
+    """Monitor job: keep probing stalled shares even when nothing looks at them."""
+    for share in SHARES.values():
+        mount_point = share['mount_point']
+        if mount_point not in share_watchdog.stalled:
+            continue
+        if mount_table.is_mounted(mount_point):
+            share_watchdog._probe(share)
+        else:
+            # Unmounted (e.g. lazily) while stalled; nothing left to wait for
+            share_watchdog.stalled.pop(mount_point, None)
+
+
+share_monitor.add_job(reprobe_stalled_shares)
+
+
+# errnos a CIFS mount returns once its server session is gone for good
+STALE_ERRNOS = {errno.ESTALE, errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.EIO,
+                errno.ENOTCONN, errno.ECONNRESET, errno.ECONNABORTED, errno.ETIMEDOUT}
+
+# Mount points with a reconnect in flight, and those whose last reconnect
+# failed.  A reconnecting share is also in pending_mounts, so nothing else
+# starts a mount of it meanwhile.
+reconnecting = set()
+reconnect_failed = set()
+
+
+def mount_is_stale(mount_point):
+    """True if a statvfs of mount_point fails the way a dead CIFS session does."""
+    try:
+        share_watchdog.call(mount_point, os.statvfs, mount_point)
+    except ShareStalled:
+        return True
+    except OSError as e:
+        return e.errno in STALE_ERRNOS
+    return False
+
+
+def reconnect_stale_shares(monitor, now):
+    """Monitor job: lazily unmount and remount tracked shares whose session went stale."""
+    settings = SHARES.settings
+    if not settings['auto_reconnect']:
+        return
+    for share in list(mounted_shares):
+        mount_point = share['mount_point']
+        if (mount_point in reconnecting or mount_point in idle_unmounts
+                or share['name'] in pending_mounts):
+            continue
+        if not mount_table.is_mounted(mount_point) or not mount_is_stale(mount_point):
+            continue
+        # Remounting only works once the server is back; until then the
+        # watchdog keeps the UI away from the dead mount
+        if probe_host(share_host(share['share_path']),
+                      port=share.get('probe_port', settings['probe_port']),
+                      timeout=share.get('probe_timeout', settings['probe_timeout']),
+                      failure_ttl=settings['probe_failure_ttl']):
+            continue
+
+        reconnecting.add(mount_point)
+        pending_mounts.add(share['name'])
+        future = share_pool.submit(reconnect_share, share, settings)
+
+        def on_done(future, share=share):
+            monitor.post(lambda: finish_reconnect(monitor.fm, share, *future.result()))
+
+        future.add_done_callback(on_done)
+
+
+def reconnect_share(share, settings):
+    """Detach a stale mount and mount the share again in place; returns (success, message)."""
+    mount_point = share['mount_point']
+    success, error = run_umount(mount_point, lazy=True, timeout=settings['lazy_unmount_timeout'])
+    if not success:
+        return False, f"Could not detach stale mount of {share['display_name']}: {error}"
+    if mount_table.is_mounted(mount_point):
+        # Another ranger session got there first
+        return True, f"Reconnected {share['display_name']}"
+    success, message = run_cifs_mount(share, settings)
+    if success:
+        message = f"Reconnected {share['display_name']}"
+    return success, message
+
+
+def finish_reconnect(fm, share, success, message):
+    """UI-thread half of a reconnect: report it and reload views of the share."""
+    mount_point = share['mount_point']
+    reconnecting.discard(mount_point)
+    pending_mounts.discard(share['name'])
+    if not success:
+        # Keep tracking the share so the next monitor tick retries, but only
+        # report the first failure of an outage
+        if mount_point not in reconnect_failed:
+            reconnect_failed.add(mount_point)
+            fm.notify(message, bad=True)
+        return
+
+    reconnect_failed.discard(mount_point)
+    share_watchdog.stalled.pop(mount_point, None)
+    fm.notify(message)
+
+    # Directory objects under the old mount describe a detached filesystem
+    refresh_share_views(fm, mount_point)
+
+    # Ranger's working directory still points into the detached mount;
+    # enter the same path on the new one, or the mount point if it's gone
+    current = fm.thistab.path
+    if current and path_under(current, mount_point):
+        fm.cd(current if os.path.isdir(current) else mount_point)
+
+
+share_monitor.add_job(reconnect_stale_shares)
+
+
+def install_share_guards():
+    """Keep ranger's own directory and file loading off stalled shares.
+
+    Ranger reloads visible directories and stats the selected file on
+    every redraw, and enters directories with isdir/chdir, all on the UI
+    thread.  Each of these first asks the watchdog whether the share is
+    answering; if it isn't, the load is skipped (the column keeps showing
+    "loading") and the stall is reported once.  This is a pre-check only:
+    ranger's own calls still run on the UI thread, so a server that dies
+    after the check, or in the middle of a large listing, can still
+    block ranger until the kernel gives up.
+
+    Entering an unmounted mount point starts a mount on demand instead;
+    until it finishes, the share's folders are drawn as "mounting...".
+    """
+    from ranger.container.directory import Directory
+    from ranger.container.fsobject import FileSystemObject
+    from ranger.core.tab import Tab
+    from ranger.gui.widgets.browsercolumn import BrowserColumn
+
+    if getattr(Directory, '_share_guarded', False):
+        return
+    Directory._share_guarded = True
+
+    def responsive(fm, path):
+        if pending_share_for(path) is not None:
+            # Only the empty mount point directory is there to load
+            return False
+        try:
+            share_watchdog.check(path)
+        except ShareStalled as e:
+            if e.fresh:
+                fm.notify(f"{e.strerror}; skipping {path} until it recovers", bad=True)
+            return False
+        return True
+
+    def guard(method, default):
+        def guarded(self, *args, **kwargs):
+            if not responsive(self.fm, self.path):
+                return default
+            return method(self, *args, **kwargs)
+        guarded.__name__ = method.__name__
+        guarded.__doc__ = method.__doc__
+        return guarded
+
+    Directory.load_content = guard(Directory.load_content, None)
+    Directory.load_content_if_outdated = guard(Directory.load_content_if_outdated, False)
+    FileSystemObject.load_if_outdated = guard(FileSystemObject.load_if_outdated, False)
+
+    enter_dir = Tab.enter_dir
+
+    def guarded_enter_dir(self, path, history=True):
+        if path is None:
+            return enter_dir(self, path, history)
+        target = os.path.normpath(os.path.join(self.path or '/', os.path.expanduser(str(path))))
+        share_name, share = unmounted_share_for(target, hooked_shares(target))
+        if share is not None:
+            if share_name not in pending_mounts:
+                command = mount_share('mount_share ' + share_name)
+                command.fm = self.fm
+                command._mount_on_demand(share_name, target)
+            # Wait in the mount point; target may only exist once it's mounted
+            path = share['mount_point']
+        elif not responsive(self.fm, target):
+            return False
+        else:
+            # A deadline-bounded stat of the target first, so that ranger's
+            # own isdir and chdir find its attributes cached
+            try:
+                share_watchdog.call(target, os.stat, target)
+            except ShareStalled as e:
+                if e.fresh:
+                    self.fm.notify(f"{e.strerror}; not entering {target}", bad=True)
+                return False
+            except OSError:
+                pass  # Let ranger report it as usual
+        return enter_dir(self, path, history)
+
+    guarded_enter_dir.__doc__ = enter_dir.__doc__
+    Tab.enter_dir = guarded_enter_dir
+
+    draw_directory = BrowserColumn._draw_directory
+
+    def guarded_draw_directory(self):
+        share = pending_share_for(self.target.path)
+        if share is None:
+            return draw_directory(self)
+        self.win.move(0, 0)
+        self.addnstr(f"mounting {share['display_name']}...", self.wid)
+        return None
+
+    BrowserColumn._draw_directory = guarded_draw_directory
+
+
+install_share_guards()
+
+
+def unmounted_share_for(path, shares=None):
+    """Return (name, entry) of the share holding path if it should be mounted on demand."""
+    name, share = share_for_path(os.path.normpath(path), shares)
+    if share is None or not share.get('automount', SHARES.peek()[1]['automount']):
+        return None, None
+    if mount_table.is_mounted(share['mount_point']):
+        return None, None
+    return name, share
+
+
+def pending_share_for(path):
+    """The share holding path if it is being mounted right now, else None."""
+    if not pending_mounts:
+        return None
+    name, share = share_for_path(path, hooked_shares(path))
+    return share if name in pending_mounts else None
+
+
+def hooked_shares(path):
+    """The shares that ranger's redraw and cd hooks should consider for path.
+
+    These hooks run while ranger starts up, which is no time to read
+    smb_shares.json.  Until a share command has loaded the registry they
+    only load it for a path on or just above a mounted CIFS share, and
+    otherwise see no shares at all.  Once loaded they use the cached
+    entries without revalidating the file; share commands do that.
+    """
+    if not SHARES.loaded:
+        if not mount_table.has_share_near(path):
+            return {}
+        SHARES.load()
+    return SHARES.peek()[0]
+
+
+def refresh_share_views(fm, mount_point):
+    """Make ranger reload every directory it has cached under mount_point."""
+    for path, directory in list(fm.directories.items()):
+        if path_under(path, mount_point):
+            directory.content_outdated = True
+
+
+def drop_file_cache(fd):
+    """Ask the kernel to forget cached pages of fd, where supported."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def benchmark_path(root, size_mb=64, small_files=500, block_size=1 << 20):
+    """Measure the filesystem under root and return the results as a dict.
+
+    Works on any writable directory, so it can be pointed at a tmpfs or
+    loopback mount as well as a share.  Everything is created in a
+    scratch directory under root that is removed afterwards.
+    """
+    scratch = os.path.join(root, f".ranger-bench-{os.getpid()}-{int(time.time())}")
+    os.mkdir(scratch)
+    results = {}
+    try:
+        # Sequential write, flushed to the server before the clock stops
+        block = os.urandom(block_size)
+        big_file = os.path.join(scratch, 'sequential')
+        start = time.perf_counter()
+        fd = os.open(big_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for _ in range(size_mb * (1 << 20) // block_size):
+                os.write(fd, block)
+            os.fsync(fd)
+            drop_file_cache(fd)
+        finally:
+            os.close(fd)
+        results['write_mb_s'] = size_mb / (time.perf_counter() - start)
+
+        # Sequential read of the same file with its cached pages dropped
+        start = time.perf_counter()
+        fd = os.open(big_file, os.O_RDONLY)
+        try:
+            drop_file_cache(fd)
+            while os.read(fd, block_size):
+                pass
+        finally:
+            os.close(fd)
+        results['read_mb_s'] = size_mb / (time.perf_counter() - start)
+        os.unlink(big_file)
+
+        # Small-file metadata operations
+        small_dir = os.path.join(scratch, 'small')
+        os.mkdir(small_dir)
+        names = [os.path.join(small_dir, f"f{i:06d}") for i in range(small_files)]
+        start = time.perf_counter()
+        for name in names:
+            os.close(os.open(name, os.O_WRONLY | os.O_CREAT, 0o644))
+        results['create_ops_s'] = small_files / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for name in names:
+            os.stat(name)
+        results['stat_ops_s'] = small_files / (time.perf_counter() - start)
+
+        # Listing a directory with small_files entries
+        start = time.perf_counter()
+        with os.scandir(small_dir) as entries:
+            for entry in entries:
+                entry.is_dir()
+        results['readdir_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for name in names:
+            os.unlink(name)
+        results['unlink_ops_s'] = small_files / (time.perf_counter() - start)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def format_bench(record):
+    return (f"read {record['read_mb_s']:.1f} MB/s, write {record['write_mb_s']:.1f} MB/s, "
+            f"create {record['create_ops_s']:.0f}/s, stat {record['stat_ops_s']:.0f}/s, "
+            f"unlink {record['unlink_ops_s']:.0f}/s, "
+            f"readdir {record['readdir_ms']:.1f} ms/{record['small_files']} entries")
+
+
+# Ranger directory objects primed after a warm-up, to bound memory use
+WARMUP_PRIME_DIRS = 32
+
+
+def warm_up_tree(root, depth, workers, max_dirs, keep_going):
+    """Walk the top depth levels under root with scandir on a thread pool.
+
+    Listing a directory and stat-ing its entries fills the kernel's CIFS
+    dentry and attribute caches, so later browsing doesn't go over the
+    wire cold.  Stops early once keep_going() returns False.  Returns
+    (directories_scanned, entries_seen, first_level_directories).
+    """
+
+    def scan(path):
+        subdirs = []
+        count = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not keep_going():
+                        break
+                    count += 1
+                    try:
+                        entry.stat(follow_symlinks=False)
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return subdirs, count
+
+    scanned = 0
+    seen = 0
+    first_level = []
+    level = [root]
+    with DaemonThreadPool(workers, thread_name_prefix='ranger-smb-warmup') as pool:
+        for current_depth in range(depth):
+            if not level or not keep_going() or scanned >= max_dirs:
+                break
+            level = level[:max_dirs - scanned]
+            next_level = []
+            for subdirs, count in pool.map(scan, level):
+                next_level.extend(subdirs)
+                seen += count
+            scanned += len(level)
+            if current_depth == 0:
+                first_level = list(next_level)
+            level = next_level
+    return scanned, seen, first_level
+
+
+def start_warmup(fm, share):
+    """Warm up a freshly mounted share in the background, if configured.
+
+    The walk is abandoned as soon as the current tab leaves the share or
+    ranger exits.
+    When it completes, ranger's own directory objects for the first
+    level are loaded too, behind anything the user is browsing.
+    """
+    settings = SHARES.settings
+    depth = share.get('warmup_depth', settings['warmup_depth'])
+    if not depth:
+        return
+    mount_point = share['mount_point']
+
+    def keep_going():
+        if share_shutdown.is_set():
+            return False
+        current = share_monitor.current_path
+        return current is None or path_under(current, mount_point)
+
+    future = job_pool.submit(warm_up_tree, mount_point, depth, settings['warmup_workers'],
+                               settings['warmup_max_dirs'], keep_going)
+
+    def on_done(results):
+        scanned, seen, first_level = results[0]
+        if not keep_going():
+            return
+        for path in first_level[:WARMUP_PRIME_DIRS]:
+            fm.get_directory(path).load_content_if_outdated(schedule=True)
+        fm.notify(f"Warmed up {share['display_name']}: {scanned} folders, {seen} entries")
+
+    fm.loader.add(ShareTask([future], f"Warming up {share['display_name']}", on_done), append=True)
+
+
+# Types rifle opens with viewers only; anything an editor could save back to
+# is always opened on the share itself
+CACHED_OPEN_TYPES = ('image/', 'audio/', 'video/', 'application/pdf', 'application/epub+zip')
+
+# Read size for cache fills; each read is one watchdog-bounded call
+CONTENT_CACHE_CHUNK = 1 << 20
+
+
+class ContentCache(object):
+    """Local read-through copies of small files on shares.
+
+    Entries live under <cachedir>/smb_content as <hash of share and
+    path>/<size>-<mtime_ns>/<file name>, so a file that changed on the
+    share simply misses, and the copy keeps its name for rifle and
+    scope.sh.  lookup() returns the local copy while it is current;
+    otherwise it returns the share path and fills the cache in the
+    background, so only the first access goes over the network.  The
+    mtime of each path's directory records its last use, and the least
+    recently used paths are evicted once the cache outgrows
+    content_cache_mb.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filling = set()
+
+    @staticmethod
+    def root():
+        args = getattr(ranger, 'args', None)
+        cachedir = getattr(args, 'cachedir', None) or os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'ranger')
+        return os.path.join(cachedir, 'smb_content')
+
+    def lookup(self, path):
+        """Return a current local copy of path, or path itself."""
+        share_name, share = share_for_path(path, hooked_shares(path))
+        settings = SHARES.peek()[1]
+        if not settings['content_cache_mb']:
+            return path
+        if (share is None or path == share['mount_point']
+                or not mount_table.is_mounted(share['mount_point'])):
+            return path
+        try:
+            st = share_watchdog.call(path, os.stat, path)
+        except OSError:
+            return path
+        if not stat.S_ISREG(st.st_mode) or st.st_size > settings['content_cache_max_file_mb'] << 20:
+            return path
+
+        key = f"{share_name}\0{os.path.relpath(path, share['mount_point'])}"
+        digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        entry_dir = os.path.join(self.root(), digest)
+        local = os.path.join(entry_dir, f"{st.st_size}-{st.st_mtime_ns}", os.path.basename(path))
+        if os.path.exists(local):
+            try:
+                os.utime(entry_dir)
+            except OSError:
+                pass
+            return local
+
+        with self._lock:
+            if local in self._filling:
+                return path
+            self._filling.add(local)
+        job_pool.submit(self._fill, path, local, st)
+        return path
+
+    def _fill(self, path, local, st):
+        version_dir = os.path.dirname(local)
+        entry_dir = os.path.dirname(version_dir)
+        partial = local + '.part'
+        try:
+            os.makedirs(version_dir, exist_ok=True)
+            share_watchdog.check(path)
+            # Read through the watchdog a chunk at a time, so a share that
+            # goes away abandons the fill instead of a worker, and an exit
+            # stops it between chunks
+            source = share_watchdog.call(path, open, path, 'rb')
+            try:
+                with open(partial, 'wb') as target:
+                    while True:
+                        stop_if_exiting(path)
+                        chunk = share_watchdog.call(path, source.read, CONTENT_CACHE_CHUNK)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+            finally:
+                source.close()
+            after = share_watchdog.call(path, os.stat, path)
+            if ((after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns)
+                    or os.path.getsize(partial) != st.st_size):
+                # Changed while we read it; the next lookup will see the new version
+                os.unlink(partial)
+                return
+            # Read-only, so nothing opened from the cache can be edited by mistake
+            os.chmod(partial, 0o444)
+            os.replace(partial, local)
+            for version in os.listdir(entry_dir):
+                if version != os.path.basename(version_dir):
+                    shutil.rmtree(os.path.join(entry_dir, version), ignore_errors=True)
+            os.utime(entry_dir)
+            self._evict()
+        except OSError:
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+        finally:
+            with self._lock:
+                self._filling.discard(local)
+
+    def _evict(self):
+        budget = SHARES.settings['content_cache_mb'] << 20
+        entries = []
+        total = 0
+        with os.scandir(self.root()) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                size = sum(os.path.getsize(os.path.join(root, name))
+                           for root, _, files in os.walk(entry.path) for name in files)
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+        for _, size, path in sorted(entries):
+            if total <= budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def open_path(self, path):
+        """lookup() for files rifle opens: only types that are opened read-only."""
+        mimetype = mimetypes.guess_type(path)[0] or ''
+        if not mimetype.startswith(CACHED_OPEN_TYPES):
+            return path
+        return self.lookup(path)
+
+
+# Single content cache shared by previews and rifle
+content_cache = ContentCache()
+
+
+def install_content_cache():
+    """Serve scope.sh previews and rifle opens of share files from content_cache."""
+    from ranger.core import actions
+    from ranger.ext.rifle import Rifle
+
+    if getattr(Rifle, '_share_cached', False):
+        return
+    Rifle._share_cached = True
+
+    # get_preview is the only user of CommandLoader in actions; its args are
+    # [preview_script, path, width, height, cacheimg, preview_images]
+    command_loader = actions.CommandLoader
+
+    class CachedPreviewLoader(command_loader):
+        def __init__(self, args, *rest, **kwargs):
+            if len(args) > 1:
+                args = [args[0], content_cache.lookup(args[1])] + list(args[2:])
+            command_loader.__init__(self, args, *rest, **kwargs)
+
+    actions.CommandLoader = CachedPreviewLoader
+
+    execute = Rifle.execute
+
+    def cached_execute(self, files, *args, **kwargs):
+        return execute(self, [content_cache.open_path(f) for f in files], *args, **kwargs)
+
+    cached_execute.__doc__ = execute.__doc__
+    Rifle.execute = cached_execute
+
+
+install_content_cache()
+
+
+class FreeSpaceCache(object):
+    """Free space on mounted shares for ranger's status bar.
+
+    With display_free_space_in_status_bar set, the status bar calls
+    statvfs on the current folder at every redraw, on the UI thread,
+    which on a share is a round trip to the server each time.  For
+    folders on a mounted share, get() answers from this cache instead
+    and refreshes it in the background (through the watchdog) once the
+    value is free_space_ttl seconds old or has been invalidated by a
+    write.  Until the first answer arrives it raises OSError, which the
+    status bar takes as "leave the free space out".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._stale = set()
+        self._refreshing = set()
+
+    def get(self, mount_point):
+        now = time.monotonic()
+        with self._lock:
+            value = self._values.get(mount_point)
+            if (value is None or mount_point in self._stale
+                    or now - value[1] >= SHARES.peek()[1]['free_space_ttl']):
+                self._refresh(mount_point)
+        if value is None:
+            raise OSError(errno.EAGAIN, "free space not known yet", mount_point)
+        return value[0]
+
+    def store(self, mount_point, st):
+        """Record the result of a statvfs of mount_point made elsewhere."""
+        with self._lock:
+            self._values[mount_point] = (st.f_bavail * st.f_frsize, time.monotonic())
+
+    def invalidate(self, mount_point):
+        """Something was written to the share; refresh at the next get()."""
+        with self._lock:
+            self._stale.add(mount_point)
+
+    def _refresh(self, mount_point):
+        # Called with self._lock held
+        if mount_point in self._refreshing:
+            return
+        self._refreshing.add(mount_point)
+        self._stale.discard(mount_point)
+
+        def run():
+            try:
+                st = share_watchdog.call(mount_point, os.statvfs, mount_point)
+            except OSError:
+                return  # Keep showing the last known value
+            finally:
+                with self._lock:
+                    self._refreshing.discard(mount_point)
+            self.store(mount_point, st)
+            if share_monitor.fm is not None:
+                share_monitor.post(lambda: share_monitor.fm.ui.status.request_redraw())
+
+        share_pool.submit(run)
+
+
+# Free space of every mounted share, for the status bar
+free_space = FreeSpaceCache()
+
+
+def install_free_space_cache():
+    """Route the status bar's free space lookups on mounted shares through free_space."""
+    from ranger.container.directory import Directory
+    from ranger.gui.widgets import statusbar
+
+    if getattr(statusbar, '_share_cached', False):
+        return
+    statusbar._share_cached = True
+
+    get_free_space = statusbar.get_free_space
+
+    def cached_get_free_space(path):
+        _, share = share_for_path(path, hooked_shares(path))
+        if share is None or not mount_table.is_mounted(share['mount_point']):
+            return get_free_space(path)
+        return free_space.get(share['mount_point'])
+
+    statusbar.get_free_space = cached_get_free_space
+
+    load_content = Directory.load_content
+
+    def invalidating_load_content(self, *args, **kwargs):
+        # Ranger reloads an already loaded folder when its mtime changed or
+        # after its own pastes, so that is when the share's free space moved
+        if self.files is not None:
+            _, share = share_for_path(self.path, hooked_shares(self.path))
+            if share is not None:
+                free_space.invalidate(share['mount_point'])
+        return load_content(self, *args, **kwargs)
+
+    invalidating_load_content.__name__ = load_content.__name__
+    invalidating_load_content.__doc__ = load_content.__doc__
+    Directory.load_content = invalidating_load_content
+
+
+install_free_space_cache()
+
+
+class TransferProgress(object):
+    """Byte counter shared by the threads of one transfer."""
+
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+
+    def percent(self):
+        return min(100, 100 * self.done / self.total) if self.total else 0
+
+
+# copy_file_range errors that just mean "not between these two filesystems"
+COPY_RANGE_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
 
-# Global list to track mounted shares
-mounted_shares = []
 
-# Load shares from external config file
-def load_shares_config():
-    """Load share definitions from external JSON config file."""
-    config_path = Path(__file__).parent / "smb_shares.json"
-    
-    if not config_path.exists():
-        # Fallback to default shares if config doesn't exist
-        return {
-            "downloads": {
-                "mount_point": "~/mnt/ArrsDownloadShare",
-                "share_path": "//vcr.int.macapinlac.network/ArrsDownloadShare",
-                "display_name": "ArrsDownloadShare"
-            },
-            "localmedia": {
-                "mount_point": "~/mnt/LocalMediaLibraryShare", 
-                "share_path": "//vcr.int.macapinlac.network/LocalMediaLibraryShare",
-                "display_name": "LocalMediaLibraryShare"
-            },
-            "savedmedia": {
-                "mount_point": "~/mnt/SavedMedia",
-                "share_path": "//10.1.0.96/SavedMedia", 
-                "display_name": "SavedMedia"
-            }
-        }
-    
+# Largest piece copied by one system call, so that progress, pausing and
+# the bandwidth cap all act at a fine grain
+COPY_PIECE = 1 << 20
+
+
+def copy_range(src_fd, dst_fd, offset, length, engine):
+    """Copy length bytes at offset from src_fd to dst_fd.
+
+    Uses copy_file_range while engine['copy_range'] is set, so the kernel
+    (or the server, for a server-side copy) moves the data, and falls back
+    to pread/pwrite for good the first time it isn't supported.  Each
+    piece is counted in engine['progress'], and engine['gate'], if set,
+    is called with the size of every piece before it is copied.  Returns
+    the number of bytes copied.
+    """
+    start = offset
+    end = offset + length
+    gate = engine.get('gate')
+    while offset < end:
+        count = min(end - offset, COPY_PIECE)
+        if gate is not None:
+            gate(count)
+        if engine['copy_range']:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in COPY_RANGE_UNSUPPORTED:
+                    raise
+                engine['copy_range'] = False
+                continue
+        else:
+            data = os.pread(src_fd, count, offset)
+            copied = len(data)
+            written = 0
+            while written < copied:
+                written += os.pwrite(dst_fd, data[written:], offset + written)
+        if copied == 0:
+            raise OSError(errno.EIO, "source ended early", f"offset {offset}")
+        engine['progress'].add(copied)
+        offset += copied
+    return offset - start
+
+
+def fetch_file(source, target, chunk_size, pool, progress, gate=None):
+    """Copy source to target in parallel chunk_size byte ranges on pool.
+
+    Data goes to target + '.part', with the finished chunks listed in
+    target + '.part.json', so an interrupted fetch of an unchanged source
+    resumes where it stopped.  At the end the source must still have the
+    size and mtime it started with, the copy gets the source's mtime and
+    is renamed into place, and the result is checked once more.
+    gate is passed on to copy_range; an exception it raises stops the
+    copy with its progress saved.  Returns the number of bytes copied, or
+    None if target was already there.
+    """
+    st = os.stat(source)
     try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-            return config.get("shares", {})
-    except (json.JSONDecodeError, IOError) as e:
-        # Log error and return empty dict if config is invalid
-        print(f"Error loading SMB shares config: {e}")
-        return {}
+        existing = os.stat(target)
+    except FileNotFoundError:
+        pass
+    else:
+        if (existing.st_size, existing.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            progress.add(st.st_size)
+            return None
+        raise FileExistsError(errno.EEXIST, "a different file is already there", target)
 
-# Load shares at module import time
-SHARES = load_shares_config()
+    part = target + '.part'
+    state_path = part + '.json'
+    state = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'chunk_size': chunk_size, 'done': []}
+    try:
+        with open(state_path, 'r') as f:
+            saved = json.load(f)
+        if (os.path.exists(part) and all(saved.get(key) == state[key]
+                                         for key in ('size', 'mtime_ns', 'chunk_size'))):
+            state['done'] = saved['done']
+    except (OSError, ValueError, KeyError):
+        pass
 
-def cleanup_mounted_shares():
-    """Unmount all shares that were mounted during this Ranger session"""
-    for share_info in mounted_shares:
+    done = set(state['done'])
+    chunk_count = (st.st_size + chunk_size - 1) // chunk_size
+    chunks = [index for index in range(chunk_count) if index not in done]
+    remaining = sum(min(chunk_size, st.st_size - index * chunk_size) for index in chunks)
+    progress.add(st.st_size - remaining)
+
+    engine = {'copy_range': hasattr(os, 'copy_file_range'), 'progress': progress, 'gate': gate}
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+    except OSError:
+        os.close(src_fd)
+        raise
+
+    def copy_chunk(index):
+        offset = index * chunk_size
+        length = min(chunk_size, st.st_size - offset)
+        copied = copy_range(src_fd, dst_fd, offset, length, engine)
+        if copied != length:
+            raise OSError(errno.EIO, f"chunk {index} copied {copied} of {length} bytes", source)
+        return index, copied
+
+    def save_state():
+        # Chunks only count as done once their data is on disk
+        os.fdatasync(dst_fd)
+        state['done'] = sorted(done)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    try:
+        # Sized up front so chunks can land in any order; what counts is
+        # the bytes each chunk actually copied, not the file size
+        os.ftruncate(dst_fd, st.st_size)
+        last_save = time.monotonic()
+        copied_size = 0
+        futures = [pool.submit(copy_chunk, index) for index in chunks]
         try:
-            mount_point = os.path.expanduser(share_info['mount_point'])
-            display_name = share_info['display_name']
-            
-            if os.path.ismount(mount_point):
-                subprocess.run(['sudo', 'umount', mount_point], 
-                             capture_output=True, text=True, timeout=10)
-                print(f"Unmounted {display_name} at {mount_point}")
-                
-                # Try to remove the mount point directory if it's empty
+            for future in as_completed(futures):
+                index, copied = future.result()
+                done.add(index)
+                copied_size += copied
+                if time.monotonic() - last_save >= 1:
+                    save_state()
+                    last_save = time.monotonic()
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            done.update(future.result()[0] for future in futures
+                        if not future.cancelled() and future.exception() is None)
+            if len(done) < chunk_count:
+                save_state()
+        os.fsync(dst_fd)
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+    after = os.stat(source)
+    if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        for path in (part, state_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        raise OSError(errno.EAGAIN, "source changed during the copy", source)
+    if copied_size != remaining:
+        raise OSError(errno.EIO, f"copied {copied_size} bytes, expected {remaining}", part)
+
+    os.utime(part, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(part, target)
+    try:
+        os.unlink(state_path)
+    except FileNotFoundError:
+        pass
+    result = os.stat(target)
+    if (result.st_size, result.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        raise OSError(errno.EIO, "size or mtime differs after the copy", target)
+    return remaining
+
+
+def verify_copy(source, target, block_size, pool, progress, gate=None):
+    """Compare source and target by the SHA-256 of each block_size segment.
+
+    Both files are dropped from the page cache first, so the check reads
+    what the server and the local disk really hold.  Every segment of
+    either file is then a task on pool that reads it with one large
+    pread and hashes it, so the two files are read and hashed in
+    parallel.  gate, if set, is called with the size of each source
+    segment before it is read.  Returns the (offset, length) segments
+    that differ; raises OSError if the sizes differ or a read fails.
+    """
+    size = os.stat(source).st_size
+    target_size = os.stat(target).st_size
+    if target_size != size:
+        raise OSError(errno.EIO, f"copy is {target_size} bytes, source {size}", target)
+    progress.total = size
+
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(target, os.O_RDONLY)
+    except OSError:
+        os.close(src_fd)
+        raise
+
+    def digest(fd, offset, length, is_source):
+        if is_source and gate is not None:
+            gate(length)
+        hasher = hashlib.sha256()
+        end = offset + length
+        while offset < end:
+            data = os.pread(fd, end - offset, offset)
+            if not data:
+                raise OSError(errno.EIO, "file ended early", f"offset {offset}")
+            hasher.update(data)
+            offset += len(data)
+        return hasher.digest()
+
+    mismatched = []
+    try:
+        for fd in (src_fd, dst_fd):
+            drop_file_cache(fd)
+        segments = [(offset, min(block_size, size - offset)) for offset in range(0, size, block_size)]
+        pending = [(segment, pool.submit(digest, src_fd, *segment, True),
+                    pool.submit(digest, dst_fd, *segment, False)) for segment in segments]
+        try:
+            for segment, source_digest, target_digest in pending:
+                if source_digest.result() != target_digest.result():
+                    mismatched.append(segment)
+                progress.add(segment[1])
+        finally:
+            futures = [future for _, *pair in pending for future in pair]
+            for future in futures:
+                future.cancel()
+            wait(futures)
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+    return mismatched
+
+
+def expand_sources(sources, dest_dir):
+    """Expand the selected files and folders into (source, target) pairs under dest_dir."""
+    pairs = []
+    for source in sources:
+        if os.path.isdir(source):
+            base = os.path.dirname(source.rstrip('/'))
+            for root, _, files in os.walk(source):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    pairs.append((path, os.path.join(dest_dir, os.path.relpath(path, base))))
+        else:
+            pairs.append((source, os.path.join(dest_dir, os.path.basename(source))))
+    return pairs
+
+
+class TransferPaused(Exception):
+    """Raised inside a queued copy to stop it, progress kept, when its job is paused or ranger exits."""
+
+
+class Throttle(object):
+    """Global bandwidth cap shared by every queued transfer.
+
+    A token bucket refilled at transfer_bandwidth_mb MiB/s (0 = no cap)
+    that holds at most one second's worth.  Foreground transfers go
+    first: background ones wait while any foreground transfer is waiting.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._foreground_waiting = 0
+
+    def consume(self, count, foreground):
+        rate = SHARES.settings['transfer_bandwidth_mb'] * (1 << 20)
+        if not rate:
+            return
+        with self._cond:
+            if foreground:
+                self._foreground_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(rate, self._tokens + (now - self._stamp) * rate)
+                    self._stamp = now
+                    if self._tokens > 0 and (foreground or not self._foreground_waiting):
+                        # Pieces are small next to a second's worth, so a
+                        # brief debt keeps the average rate exact
+                        self._tokens -= count
+                        return
+                    self._cond.wait(max(-self._tokens / rate, 0.01))
+            finally:
+                if foreground:
+                    self._foreground_waiting -= 1
+                    self._cond.notify_all()
+
+
+class TransferQueue(object):
+    """Persistent queue of file copies between shares and local disk.
+
+    Each job copies one file with fetch_file, so a paused or interrupted
+    job resumes from its .part file.  A scheduler thread starts queued
+    jobs in order, foreground jobs first, at most
+    transfer_share_concurrency at a time per share and only while that
+    share is mounted and responding.  Every copied piece passes through
+    the shared Throttle.
+
+    Each ranger session saves its queue to smb_transfers/<pid>-<start
+    time>.json in ranger's data directory whenever a job changes state,
+    and the first session to start transfers afterwards adopts the
+    unfinished jobs of sessions that have exited.  on_finished callbacks
+    run on the UI thread through share_monitor.post().
+    """
+
+    # How many seconds of progress samples the throughput is averaged over
+    rate_window = 5
+
+    def __init__(self):
+        self.jobs = []
+        self.throttle = Throttle()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._path = None
+        self._active = {}
+        self._batches = {}
+        self._next_id = 1
+        self._next_batch = 1
+
+    def start(self):
+        """Adopt saved queues of exited sessions and start the scheduler."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            adopted = 0
+            try:
+                directory = os.path.join(share_datadir(), 'smb_transfers')
+                os.makedirs(directory, exist_ok=True)
+                pid = os.getpid()
+                self._path = os.path.join(directory, f"{pid}-{process_start_time(pid)}.json")
+                adopted = self._adopt(directory)
+            except OSError:
+                self._path = None  # Run without persistence rather than not at all
+            self._thread = threading.Thread(target=self._run, name='ranger-smb-transfers', daemon=True)
+            self._thread.start()
+        if adopted:
+            share_monitor.post(lambda: share_monitor.fm.notify(
+                f"Resuming {adopted} transfer(s) left by an earlier ranger session (:transfers)"))
+
+    def _adopt(self, directory):
+        with open(os.path.join(directory, 'smb_transfers.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for name in sorted(os.listdir(directory)):
+                match = re.match(r'^(\d+)-(\w+)\.json$', name)
+                path = os.path.join(directory, name)
+                if not match or path == self._path:
+                    continue
+                if str(process_start_time(int(match.group(1)))) == match.group(2):
+                    continue  # That session is still running
+                try:
+                    with open(path, 'r') as f:
+                        jobs = json.load(f)
+                except (OSError, ValueError):
+                    jobs = []
+                for job in jobs:
+                    if job.get('state') not in ('queued', 'running', 'paused'):
+                        continue
+                    job.update(id=self._next_id, batch=None, done=0,
+                               state='paused' if job['state'] == 'paused' else 'queued')
+                    self._next_id += 1
+                    self.jobs.append(job)
+                os.unlink(path)
+            self._save()
+        return len(self.jobs)
+
+    def _save(self):
+        """Write the queue to disk; the caller holds self._lock."""
+        if self._path is None:
+            return
+        try:
+            with open(self._path + '.tmp', 'w') as f:
+                json.dump(self.jobs, f)
+            os.replace(self._path + '.tmp', self._path)
+        except OSError:
+            pass
+
+    def add(self, pairs, share_name, foreground=False, on_finished=None, verify=False):
+        """Queue (source, target) copies that involve share_name.
+
+        With verify, each copy is checked against its source with
+        verify_copy() before the job counts as done.  on_finished(jobs)
+        runs on the UI thread once every job of this batch has finished
+        or failed.
+        """
+        self.start()
+        with self._lock:
+            batch = self._next_batch
+            self._next_batch += 1
+            for source, target in pairs:
+                self.jobs.append({'id': self._next_id, 'batch': batch, 'share': share_name,
+                                  'source': source, 'target': target, 'foreground': foreground,
+                                  'state': 'queued', 'size': None, 'done': 0,
+                                  'copied': None, 'error': None, 'phase': 'copy',
+                                  'verify': verify, 'verify_mbps': None})
+                self._next_id += 1
+            if on_finished is not None:
+                self._batches[batch] = on_finished
+            self._save()
+        self._wakeup.set()
+        return batch
+
+    def _select(self, ids):
+        return [job for job in self.jobs if ids is None or job['id'] in ids]
+
+    def has_work(self, share_name):
+        """True while jobs involving share_name are queued or running."""
+        with self._lock:
+            return any(job['share'] == share_name and job['state'] in ('queued', 'running')
+                       for job in self.jobs)
+
+    def pause(self, ids=None):
+        """Pause the given jobs (all when ids is None); running ones stop after their current piece."""
+        with self._lock:
+            for job in self._select(ids):
+                if job['state'] == 'queued':
+                    job['state'] = 'paused'
+                elif job['state'] == 'running':
+                    self._active[job['id']]['pause'] = True
+            self._save()
+
+    def resume(self, ids=None):
+        with self._lock:
+            for job in self._select(ids):
+                if job['state'] in ('paused', 'failed'):
+                    job.update(state='queued', error=None)
+            self._save()
+        self._wakeup.set()
+
+    def prioritize(self, ids):
+        """Treat jobs as foreground, both in the queue order and for bandwidth."""
+        with self._lock:
+            for job in self._select(ids):
+                job['foreground'] = True
+            self._save()
+        self._wakeup.set()
+
+    def clear(self):
+        """Forget finished and failed jobs."""
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job['state'] not in ('done', 'failed')]
+            self._save()
+
+    def snapshot(self):
+        """Copies of all jobs, with live progress and throughput (bytes/s) for running ones."""
+        now = time.monotonic()
+        jobs = []
+        with self._lock:
+            for job in self.jobs:
+                job = dict(job, rate=None)
+                control = self._active.get(job['id'])
+                if control is not None:
+                    progress = control['progress']
+                    job['size'] = progress.total or job['size']
+                    job['done'] = progress.done
+                    samples = control['samples']
+                    samples.append((now, progress.done))
+                    while len(samples) > 2 and now - samples[1][0] >= self.rate_window:
+                        samples.popleft()
+                    start, start_done = samples[0]
+                    if now - start > 0.2:
+                        job['rate'] = (progress.done - start_done) / (now - start)
+                jobs.append(job)
+        return jobs
+
+    def _run(self):
+        while True:
+            # Also re-check every second, since shares come and go
+            self._wakeup.wait(1)
+            self._wakeup.clear()
+            with self._lock:
+                started = self._startable()
+                for job in started:
+                    job['state'] = 'running'
+                    control = {'progress': TransferProgress(), 'pause': False, 'samples': deque()}
+                    self._active[job['id']] = control
+                    threading.Thread(target=self._execute, args=(job, control),
+                                     name='ranger-smb-transfer', daemon=True).start()
+                if started:
+                    self._save()
+
+    def _startable(self):
+        if share_shutdown.is_set():
+            return []
+        limit = SHARES.settings['transfer_share_concurrency']
+        running = {}
+        for job in self.jobs:
+            if job['state'] == 'running':
+                running[job['share']] = running.get(job['share'], 0) + 1
+        ready = []
+        queued = [job for job in self.jobs if job['state'] == 'queued']
+        for job in sorted(queued, key=lambda job: (not job['foreground'], job['id'])):
+            share = SHARES.get(job['share'])
+            if share is None:
+                job.update(state='failed', error="share is no longer configured")
+                continue
+            mount_point = share['mount_point']
+            if not mount_table.is_mounted(mount_point) or mount_point in share_watchdog.stalled:
+                continue
+            if running.get(job['share'], 0) >= limit:
+                continue
+            running[job['share']] = running.get(job['share'], 0) + 1
+            ready.append(job)
+        return ready
+
+    def _execute(self, job, control):
+        settings = SHARES.settings
+        progress = control['progress']
+
+        def gate(count):
+            # Quitting ranger stops the job too, but leaves it queued so
+            # that the next session resumes it
+            if control['pause'] or share_shutdown.is_set():
+                raise TransferPaused()
+            self.throttle.consume(count, job['foreground'])
+            # Waiting for bandwidth can take a while, so look again
+            if control['pause'] or share_shutdown.is_set():
+                raise TransferPaused()
+
+        timer = PhaseTimer()
+        state, copied, error = 'done', None, None
+        try:
+            progress.total = os.stat(job['source']).st_size
+            os.makedirs(os.path.dirname(job['target']), exist_ok=True)
+            with DaemonThreadPool(settings['fetch_workers'], thread_name_prefix='ranger-smb-chunk') as pool:
+                with timer.phase('copy'):
+                    copied = fetch_file(job['source'], job['target'], settings['fetch_chunk_mb'] << 20,
+                                        pool, progress, gate)
+            if copied is None:
+                copied = job['copied']  # Copied by an earlier run of this job
+            if job.get('verify'):
+                with self._lock:
+                    job.update(phase='verify', copied=copied)
+                    control['progress'] = progress = TransferProgress()
+                    control['samples'].clear()
+                self._verify(job, gate, progress, timer)
+        except TransferPaused:
+            state = 'paused' if control['pause'] else 'queued'
+        except OSError as e:
+            state, error = 'failed', e.strerror or str(e)
+            share_telemetry.record('transfer', job['share'], timer, error_class=type(e).__name__)
+        else:
+            share_telemetry.record('transfer', job['share'], timer, 0)
+
+        _, target_share = share_for_path(job['target'])
+        if target_share is not None:
+            free_space.invalidate(target_share['mount_point'])
+        finished = None
+        with self._lock:
+            job.update(state=state, copied=copied, error=error, size=progress.total, done=progress.done,
+                       phase='copy')
+            del self._active[job['id']]
+            batch = [other for other in self.jobs if other['batch'] == job['batch']]
+            if job['batch'] in self._batches and all(other['state'] in ('done', 'failed')
+                                                     for other in batch):
+                finished = self._batches.pop(job['batch'])
+                batch = [dict(other) for other in batch]
+            self._save()
+        self._wakeup.set()
+        if finished is not None:
+            share_monitor.post(lambda: finished(batch))
+
+    def _verify(self, job, gate, progress, timer):
+        """Check a finished copy against its source; raises OSError on a mismatch."""
+        settings = SHARES.settings
+        started = time.perf_counter()
+        with DaemonThreadPool(settings['verify_workers'], thread_name_prefix='ranger-smb-verify') as pool:
+            with timer.phase('verify'):
+                mismatched = verify_copy(job['source'], job['target'], settings['verify_block_mb'] << 20,
+                                         pool, progress, gate)
+        seconds = max(time.perf_counter() - started, 0.001)
+        job['verify_mbps'] = round(progress.total / (1 << 20) / seconds, 1)
+        if mismatched:
+            # Set the bad copy aside, so running the transfer again copies it afresh
+            os.replace(job['target'], job['target'] + '.mismatch')
+            ranges = ', '.join(f"{offset >> 20}-{(offset + length) >> 20}" for offset, length in mismatched[:3])
+            raise OSError(errno.EIO, f"checksum mismatch at MiB {ranges}; kept as .mismatch")
+
+
+# Single transfer queue shared by :fetch_from_share, :push_to_share and :transfers
+transfer_queue = TransferQueue()
+
+
+def transfer_report(jobs, started):
+    """One-line summary of a finished batch of transfer jobs, and whether any failed."""
+    copied = [job for job in jobs if job['state'] == 'done' and job['copied'] is not None]
+    skipped = [job for job in jobs if job['state'] == 'done' and job['copied'] is None]
+    failed = [job for job in jobs if job['state'] == 'failed']
+    copied_mib = sum(job['copied'] for job in copied) / (1 << 20)
+    elapsed = max(time.monotonic() - started, 0.001)
+    report = (f"{len(copied)} file(s), {copied_mib:.1f} MiB in {elapsed:.1f}s"
+              f" ({copied_mib / elapsed:.1f} MB/s)")
+    if skipped:
+        report += f"; {len(skipped)} already there"
+    verified = [job for job in jobs if job['state'] == 'done' and job.get('verify')]
+    if verified:
+        verified_mib = sum(job['size'] or 0 for job in verified) / (1 << 20)
+        seconds = sum((job['size'] or 0) / (1 << 20) / job['verify_mbps']
+                      for job in verified if job['verify_mbps'])
+        report += f"; {len(verified)} verified by checksum"
+        if seconds:
+            report += f" ({verified_mib / seconds:.1f} MB/s)"
+    if failed:
+        report += "; failed: " + ', '.join(f"{os.path.basename(job['source'])} ({job['error']})"
+                                            for job in failed)
+    return report, bool(failed)
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def walk_files(root, workers):
+    """Return {relative_path: (size, mtime_ns)} for every file below root.
+
+    Folders are listed level by level on a thread pool, the same way
+    ShareIndex.refresh() walks a share, so a large tree costs a few
+    round trips per level instead of one per folder.  Raises
+    InterruptedError if ranger exits before the walk is complete.
+    """
+
+    def scan(rel):
+        full = os.path.join(root, rel) if rel else root
+        files, subdirs = [], []
+        stop_if_exiting(full)
+        with os.scandir(full) as entries:
+            for entry in entries:
+                path = os.path.join(rel, entry.name) if rel else entry.name
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    files.append((path, st.st_size, st.st_mtime_ns))
+        return files, subdirs
+
+    found = {}
+    level = ['']
+    with DaemonThreadPool(workers, thread_name_prefix='ranger-smb-walk') as pool:
+        while level:
+            next_level = []
+            for files, subdirs in pool.map(scan, level):
+                for path, size, mtime_ns in files:
+                    found[path] = (size, mtime_ns)
+                next_level.extend(subdirs)
+            level = next_level
+    return found
+
+
+class ShareMirror(object):
+    """One-way mirror of a folder on a share into a local folder.
+
+    The manifest, smb_mirrors/<key>.json in ranger's data directory,
+    records the size and mtime (and, with mirror_hash, the SHA-256) of
+    every file the mirror copied.  A run walks the source in parallel,
+    compares it with the manifest and with the local files, and copies
+    only what is new or changed, so an unchanged tree costs one
+    parallel walk of the share and a local stat per file.  Files that
+    were changed locally are never overwritten, and files that left the
+    share are kept locally and only dropped from the manifest.
+    """
+
+    # Seconds between manifest saves while files are being copied
+    save_interval = 5
+
+    def __init__(self, share_name, source, dest):
+        self.share_name = share_name
+        self.source = source
+        self.dest = dest
+        key = hashlib.sha1(f"{share_name}\0{source}\0{dest}".encode()).hexdigest()
+        self.path = os.path.join(share_datadir(), 'smb_mirrors', key + '.json')
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save(self, files):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        manifest = {'share': self.share_name, 'source': self.source, 'dest': self.dest, 'files': files}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def plan(self, remote, manifest, check):
+        """Sort the remote files into (copy, unchanged, conflicts).
+
+        copy lists (path, replace) pairs; replace means the local file is
+        an older mirrored copy that must go first.  With check, local
+        copies with a recorded hash are re-hashed and copied again if
+        they no longer match.
+        """
+        copy, unchanged, conflicts = [], [], []
+        for path, (size, mtime_ns) in sorted(remote.items()):
+            recorded = manifest.get(path)
+            try:
+                local = os.stat(os.path.join(self.dest, path))
+            except FileNotFoundError:
+                copy.append((path, False))
+                continue
+            local_sig = [local.st_size, local.st_mtime_ns]
+            if local_sig == [size, mtime_ns]:
+                if (check and recorded and recorded[2]
+                        and file_sha256(os.path.join(self.dest, path)) != recorded[2]):
+                    copy.append((path, True))
+                else:
+                    unchanged.append(path)
+            elif recorded and local_sig == recorded[:2]:
+                copy.append((path, True))
+            else:
+                conflicts.append(path)
+        return copy, unchanged, conflicts
+
+    def run(self, settings, check=False):
+        """Bring dest up to date; returns a summary dict."""
+        timer = PhaseTimer()
+        manifest = self.load()
+        with timer.phase('walk'):
+            remote = walk_files(self.source, settings['mirror_workers'])
+        with timer.phase('plan'):
+            copy, unchanged, conflicts = self.plan(remote, manifest, check)
+
+        files = {path: entry for path, entry in manifest.items() if path in remote}
+        for path in unchanged:
+            if path not in files or files[path][:2] != list(remote[path]):
+                files[path] = list(remote[path]) + [None]
+        gone = len(set(manifest) - set(remote))
+
+        copied, failed = [], []
+        copied_bytes = [0]
+        lock = threading.Lock()
+        last_save = [time.monotonic()]
+        chunk_size = settings['fetch_chunk_mb'] << 20
+        throttle = transfer_queue.throttle
+
+        def gate(count):
+            # Mirrors are background traffic under the transfer queue's cap
+            stop_if_exiting(self.source)
+            throttle.consume(count, False)
+
+        with DaemonThreadPool(settings['fetch_workers'], thread_name_prefix='ranger-smb-chunk') as chunk_pool:
+            def copy_one(path, replace):
+                target = os.path.join(self.dest, path)
                 try:
-                    os.rmdir(mount_point)
-                    print(f"Removed mount point directory: {mount_point}")
+                    stop_if_exiting(target)
+                    if replace:
+                        os.unlink(target)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    count = fetch_file(os.path.join(self.source, path), target, chunk_size, chunk_pool,
+                                       TransferProgress(), gate)
+                    digest = file_sha256(target) if settings['mirror_hash'] else None
+                    st = os.stat(target)
                 except OSError as e:
-                    # Directory not empty or other error - just log it
-                    print(f"Could not remove mount point directory {mount_point}: {e}")
-                    
-        except Exception as e:
-            print(f"Failed to unmount {display_name}: {e}")
+                    with lock:
+                        failed.append(f"{path} ({e.strerror or e})")
+                    return
+                with lock:
+                    files[path] = [st.st_size, st.st_mtime_ns, digest]
+                    copied.append(path)
+                    copied_bytes[0] += count or 0
+                    if time.monotonic() - last_save[0] >= self.save_interval:
+                        self.save(files)
+                        last_save[0] = time.monotonic()
 
-# Register cleanup function to run when Python exits
-atexit.register(cleanup_mounted_shares)
+            try:
+                with timer.phase('copy'):
+                    with DaemonThreadPool(settings['mirror_workers'],
+                                          thread_name_prefix='ranger-smb-mirror') as file_pool:
+                        wait([file_pool.submit(copy_one, path, replace) for path, replace in copy])
+            finally:
+                with lock:
+                    self.save(files)
+
+        share_telemetry.record('mirror', self.share_name, timer, 1 if failed else 0)
+        return {'files': len(remote), 'copied': len(copied), 'bytes': copied_bytes[0],
+                'unchanged': len(unchanged), 'conflicts': conflicts, 'failed': failed,
+                'gone': gone, 'seconds': timer.total_ms() / 1000}
+
+
+class ShareIndex(object):
+    """SQLite index of the paths on one share, for :share_find.
+
+    Stored as smb_index/<share>.sqlite in ranger's data directory: one
+    row per file or folder (path relative to the mount point, size,
+    mtime) with an FTS5 trigram index over the paths, plus the mtime
+    each folder had when it was last listed.  refresh() only re-lists
+    folders whose mtime changed and walks the folders it already knows
+    below unchanged ones, so keeping a large share current costs one
+    stat per folder.  A file rewritten in place doesn't change its
+    folder's mtime, so its size and mtime are refreshed the next time
+    something is added to or removed from that folder.  The meta table
+    records when the last refresh ran to completion; a refresh that is
+    cut short leaves no such record.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, parent TEXT NOT NULL,
+            size INTEGER, mtime_ns INTEGER, is_dir INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts (rowid, path) VALUES (new.id, new.path);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts (entries_fts, rowid, path) VALUES ('delete', old.id, old.path);
+        END;
+    """
+
+    def __init__(self, share_name):
+        self.share_name = share_name
+        self.path = os.path.join(share_datadir(), 'smb_index', share_name + '.sqlite')
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5"
+                         "(path, content='entries', content_rowid='id', tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # SQLite older than 3.34 has no trigram tokenizer; match whole words instead
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5"
+                         "(path, content='entries', content_rowid='id')")
+        conn.executescript(self.schema)
+        return conn
+
+    def completed(self):
+        """Time the last refresh finished, or None if the index may be partial."""
+        if not os.path.exists(self.path):
+            return None
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'completed'").fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    @staticmethod
+    def _subtree(path):
+        """WHERE clause arguments matching everything below path."""
+        # '0' sorts right after '/', so this range is exactly "path/..."
+        return path + '/', path + '0'
+
+    def refresh(self, root, workers, keep_going):
+        """Bring the index up to date with the tree under root.
+
+        Returns (folders_listed, folders_unchanged, entries), or None if
+        keep_going() turned False before the walk finished.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM meta WHERE key = 'completed'")
+            known = dict(conn.execute("SELECT path, mtime_ns FROM dirs"))
+
+            def scan(rel):
+                # Runs on the pool: stat the folder, list it only if it changed
+                if not keep_going():
+                    return rel, None, None
+                full = os.path.join(root, rel) if rel else root
+                try:
+                    mtime_ns = os.stat(full).st_mtime_ns
+                except OSError:
+                    return rel, None, None
+                if known.get(rel) == mtime_ns:
+                    return rel, mtime_ns, None
+                rows = []
+                try:
+                    with os.scandir(full) as entries:
+                        for entry in entries:
+                            try:
+                                st = entry.stat(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            is_dir = stat.S_ISDIR(st.st_mode)
+                            path = os.path.join(rel, entry.name) if rel else entry.name
+                            rows.append((path, rel, 0 if is_dir else st.st_size,
+                                         st.st_mtime_ns, int(is_dir)))
+                except OSError:
+                    return rel, None, None
+                return rel, mtime_ns, rows
+
+            listed = unchanged = 0
+            seen = set()
+            level = ['']
+            with DaemonThreadPool(workers, thread_name_prefix='ranger-smb-index') as pool:
+                while level:
+                    if not keep_going():
+                        return None
+                    next_level = []
+                    for rel, mtime_ns, rows in pool.map(scan, level):
+                        if mtime_ns is None:
+                            continue
+                        seen.add(rel)
+                        if rows is None:
+                            unchanged += 1
+                            next_level.extend(path for (path,) in conn.execute(
+                                "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (rel,)))
+                            continue
+                        listed += 1
+                        self._store_listing(conn, rel, mtime_ns, rows)
+                        next_level.extend(row[0] for row in rows if row[4])
+                    level = next_level
+            if not keep_going():
+                return None  # Folders skipped by the last level would look deleted
+
+            with conn:
+                for (path,) in conn.execute("SELECT path FROM dirs").fetchall():
+                    if path not in seen:
+                        conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('completed', ?)",
+                             (time.time(),))
+            total = conn.execute("SELECT count(*) FROM entries").fetchone()[0]
+            return listed, unchanged, total
+        finally:
+            conn.close()
+
+    def _store_listing(self, conn, rel, mtime_ns, rows):
+        names = {row[0] for row in rows}
+        with conn:
+            for (path,) in conn.execute("SELECT path FROM entries WHERE parent = ?", (rel,)).fetchall():
+                if path not in names:
+                    conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+                                 (path,) + self._subtree(path))
+                    conn.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                                 (path,) + self._subtree(path))
+            conn.executemany(
+                "INSERT INTO entries (path, parent, size, mtime_ns, is_dir) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (path) DO UPDATE SET size = excluded.size,"
+                " mtime_ns = excluded.mtime_ns, is_dir = excluded.is_dir", rows)
+            conn.execute("INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)", (rel, mtime_ns))
+
+    def search(self, query, limit=1000):
+        """Return [(relative_path, size, mtime_ns, is_dir)] for paths containing every word of query."""
+        terms = query.split()
+        conn = self.connect()
+        try:
+            if all(len(term) >= 3 for term in terms):
+                match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+                sql = ("SELECT entries.path, size, mtime_ns, is_dir FROM entries_fts"
+                       " JOIN entries ON entries.id = entries_fts.rowid"
+                       " WHERE entries_fts MATCH ? LIMIT ?")
+                return conn.execute(sql, (match, limit)).fetchall()
+            # Trigrams need three characters; short terms fall back to a scan
+            where = ' AND '.join(["path LIKE ? ESCAPE '\\'"] * len(terms))
+            patterns = ['%' + re.sub(r'([%_\\])', r'\\\1', term) + '%' for term in terms]
+            sql = f"SELECT path, size, mtime_ns, is_dir FROM entries WHERE {where} LIMIT ?"
+            return conn.execute(sql, patterns + [limit]).fetchall()
+        finally:
+            conn.close()
+
+
+# Share indexes are refreshed one at a time, off the mount pool
+index_pool = DaemonThreadPool(1, thread_name_prefix='ranger-smb-indexer')
+
+# Names of shares with an index refresh queued or running, and when each
+# tracked mount point was last refreshed
+indexing = set()
+indexing_lock = threading.Lock()
+last_indexed = {}
+
+
+def start_indexing(share):
+    """Queue a background refresh of share's index, unless one is pending."""
+    settings = SHARES.settings
+    name = share['name']
+    mount_point = share['mount_point']
+    if not share.get('index', settings['index']):
+        return
+    with indexing_lock:
+        if name in indexing:
+            return
+        indexing.add(name)
+    last_indexed[mount_point] = time.monotonic()
+
+    def keep_going():
+        return (not share_shutdown.is_set() and mount_table.is_mounted(mount_point)
+                and mount_point not in share_watchdog.stalled)
+
+    def run():
+        index = ShareIndex(name)
+        first = not os.path.exists(index.path)
+        try:
+            with share_in_use(mount_point):
+                result = index.refresh(mount_point, settings['index_workers'], keep_going)
+        except (OSError, sqlite3.Error) as e:
+            message = f"Indexing {share['display_name']} failed: {e}"
+            share_monitor.post(lambda: share_monitor.fm.notify(message, bad=True))
+            return
+        finally:
+            with indexing_lock:
+                indexing.discard(name)
+        if first and result is not None:
+            message = f"Indexed {share['display_name']}: {result[2]} entries"
+            share_monitor.post(lambda: share_monitor.fm.notify(message))
+
+    index_pool.submit(run)
+
+
+def refresh_share_indexes(monitor, now):
+    """Monitor job: refresh the index of each tracked share every index_interval seconds."""
+    interval = SHARES.settings['index_interval']
+    for share in list(mounted_shares):
+        if interval and now - last_indexed.get(share['mount_point'], 0) >= interval:
+            start_indexing(share)
+
+
+share_monitor.add_job(refresh_share_indexes)
+
+
+# Bytes read from each end of a file for the duplicate finder's first pass
+PARTIAL_HASH_BYTES = 64 << 10
+
+
+def partial_digest(path, size):
+    """SHA-1 of the first and last PARTIAL_HASH_BYTES of path, or None if it can't be read."""
+    stop_if_exiting(path)
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            digest.update(f.read(PARTIAL_HASH_BYTES))
+            if size > 2 * PARTIAL_HASH_BYTES:
+                f.seek(size - PARTIAL_HASH_BYTES)
+            digest.update(f.read(PARTIAL_HASH_BYTES))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def full_digest(path):
+    """SHA-256 of path, or None if it can't be read, for the hashing pool.
+
+    Like file_sha256(), but stops between blocks once ranger is exiting.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                stop_if_exiting(path)
+                digest.update(block)
+    except InterruptedError:
+        raise
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def duplicate_candidates(shares, settings):
+    """Return {size: [path, ...]} of files on shares that share their size with another file.
+
+    Files come from each share's index where its last refresh completed
+    and from a parallel walk otherwise.  Index entries are stat-ed again, since a
+    file changed in place keeps its old size in the index.
+    """
+    min_size = max(1, settings['dupes_min_mb'] << 20)
+    by_size = {}
+    from_index = []
+    for share in shares:
+        index = ShareIndex(share['name'])
+        if share['name'] not in indexing and index.completed() is not None:
+            conn = index.connect()
+            try:
+                rows = conn.execute("SELECT path, size FROM entries WHERE is_dir = 0 AND size >= ?",
+                                    (min_size,)).fetchall()
+            finally:
+                conn.close()
+            for path, size in rows:
+                full = os.path.join(share['mount_point'], path)
+                by_size.setdefault(size, []).append(full)
+                from_index.append(full)
+        else:
+            for path, (size, _) in walk_files(share['mount_point'], settings['index_workers']).items():
+                if size >= min_size:
+                    by_size.setdefault(size, []).append(os.path.join(share['mount_point'], path))
+
+    candidates = {path for paths in by_size.values() if len(paths) > 1 for path in paths}
+    recheck = [path for path in from_index if path in candidates]
+
+    def current_size(path):
+        stop_if_exiting(path)
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    with DaemonThreadPool(settings['index_workers'], thread_name_prefix='ranger-smb-stat') as pool:
+        sizes = dict(zip(recheck, pool.map(current_size, recheck)))
+    groups = {}
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            current = sizes.get(path, size)
+            if current is not None and current >= min_size:
+                groups.setdefault(current, []).append(path)
+    return {size: paths for size, paths in groups.items() if len(paths) > 1}
+
+
+def find_duplicates(shares, settings):
+    """Find files with identical content on the given shares.
+
+    Files are grouped by size, then the candidates of each size by a
+    hash of their first and last 64 KiB, and only what still collides is
+    hashed in full.  Both hashing passes run on dupes_workers threads;
+    hashlib releases the GIL while hashing, so they hash in parallel.
+    Returns (sets, stats): (size, paths) for each set of equal files,
+    the one to keep first, and a dict of counts and timings.
+    """
+    timer = PhaseTimer()
+    with timer.phase('sizes'):
+        groups = duplicate_candidates(shares, settings)
+    candidates = sum(len(paths) for paths in groups.values())
+
+    hashed_bytes = 0
+    with DaemonThreadPool(settings['dupes_workers'], thread_name_prefix='ranger-smb-hash') as pool:
+        with timer.phase('partial'):
+            jobs = [(size, path) for size, paths in groups.items() for path in paths]
+            digests = pool.map(partial_digest, [path for _, path in jobs], [size for size, _ in jobs])
+            partial = {}
+            for (size, path), digest in zip(jobs, digests):
+                if digest is not None:
+                    partial.setdefault((size, digest), []).append(path)
+                    hashed_bytes += min(size, 2 * PARTIAL_HASH_BYTES)
+
+        sets = []
+        with timer.phase('full'):
+            jobs = []
+            for (size, _), paths in partial.items():
+                if len(paths) < 2:
+                    continue
+                if size <= 2 * PARTIAL_HASH_BYTES:
+                    sets.append((size, paths))  # The partial hash already covered every byte
+                else:
+                    jobs.extend((size, path) for path in paths)
+            full = {}
+            for (size, path), digest in zip(jobs, pool.map(full_digest, [path for _, path in jobs])):
+                if digest is not None:
+                    full.setdefault((size, digest), []).append(path)
+                    hashed_bytes += size
+            sets.extend((size, paths) for (size, _), paths in full.items() if len(paths) > 1)
+
+    order = {share['mount_point']: position for position, share in enumerate(shares)}
+
+    def keep_first(path):
+        # Keep the copy on the earliest listed share, then the shortest path
+        share_rank = min(rank for mount_point, rank in order.items() if path_under(path, mount_point))
+        return share_rank, len(path), path
+
+    # Largest savings first
+    sets = sorted(((size, sorted(paths, key=keep_first)) for size, paths in sets),
+                  key=lambda entry: (-entry[0] * (len(entry[1]) - 1), entry[1][0]))
+    seconds = timer.total_ms() / 1000
+    stats = {'candidates': candidates, 'hashed_mb': hashed_bytes / (1 << 20),
+             'seconds': seconds, 'phases': timer.phases}
+    return sets, stats
+
+
+def format_size(size):
+    """Short human-readable size, e.g. 1.5T."""
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def share_status(share, settings):
+    """Collect one share's :list_mounted_shares row; runs on a worker thread.
+
+    Each probe has its own deadline: the server connect gives up after
+    probe_timeout and the statvfs after fs_timeout (through the
+    watchdog), so one dead share only ever delays its own row.
+    """
+    mount_point = share['mount_point']
+    status = {'mounted': False, 'stalled': False, 'total': None, 'used': None, 'free': None,
+              'fs_ms': None, 'net_ms': None, 'options': None, 'error': None}
+
+    host = share_host(share['share_path'])
+    port = share.get('probe_port', settings['probe_port'])
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port),
+                                      timeout=share.get('probe_timeout', settings['probe_timeout'])):
+            status['net_ms'] = (time.perf_counter() - start) * 1000
+    except OSError:
+        pass
+
+    entry = mount_table.get(mount_point)
+    if entry is None:
+        return status
+    status['mounted'] = True
+    status['options'] = entry['options']
+    start = time.perf_counter()
+    try:
+        st = share_watchdog.call(mount_point, os.statvfs, mount_point)
+    except ShareStalled:
+        status['stalled'] = True
+    except OSError as e:
+        status['error'] = e.strerror or str(e)
+    else:
+        status['fs_ms'] = (time.perf_counter() - start) * 1000
+        status['total'] = st.f_blocks * st.f_frsize
+        status['used'] = (st.f_blocks - st.f_bfree) * st.f_frsize
+        status['free'] = st.f_bavail * st.f_frsize
+        free_space.store(mount_point, st)
+    return status
 
 
 # Any class that is a subclass of "Command" will be integrated into ranger as a
@@ -132,82 +3401,285 @@ class my_edit(Command):
         return self._tab_directory_content()
 
 
+class cd(ranger_cd):
+    """:cd [-r] <path>
+
+    Ranger's cd, plus mount on demand: completing a path inside the
+    mount point of an unmounted share starts mounting it in the
+    background, and entering it waits there until the share is up.
+    """
+
+    def execute(self):
+        # The cd hook only knows shares once something has loaded them
+        SHARES.load()
+        return ranger_cd.execute(self)
+
+    def tab(self, tabnum):
+        _, _, dest_abs, ends_with_sep = self._tab_args()
+        share_name, share = unmounted_share_for(dest_abs)
+        if share is not None:
+            if share_name not in pending_mounts:
+                command = mount_share('mount_share ' + share_name)
+                command.fm = self.fm
+                command._mount_on_demand(share_name)
+            # Complete inside the share once it's mounted rather than
+            # listing the empty mount point
+            if ends_with_sep or os.path.normpath(dest_abs) != share['mount_point']:
+                return None
+        return ranger_cd.tab(self, tabnum)
+
+
 class mount_share(Command):
-    """:mount_share <share_name>
+    """:mount_share <share_name|group_name|all>
 
     Mount an SMB share by name and navigate to it.
-    
+
     Available shares:
     - downloads: Mounts ArrsDownloadShare
     - localmedia: Mounts LocalMediaLibraryShare
     - savedmedia: Mounts SavedMedia
-    
+
+    Groups defined under "groups" in smb_shares.json, and the special name
+    "all", mount every member share concurrently and report once when the
+    slowest one finishes.
+
     Examples:
     :mount_share downloads
     :mount_share localmedia
     :mount_share savedmedia
+    :mount_share media
+    :mount_share all
     """
 
-    def execute(self):
-        if not self.arg(1):
-            self.fm.notify("Please specify a share name (downloads, localmedia, or savedmedia)", bad=True)
+    def execute(self):
+        if not self.arg(1):
+            self.fm.notify("Please specify a share name (downloads, localmedia, or savedmedia)", bad=True)
+            return
+
+        name = self.arg(1).lower()
+
+        if name == 'all':
+            self._mount_group('all', list(SHARES.keys()))
+        elif name in SHARES.groups:
+            self._mount_group(name, SHARES.groups[name])
+        elif name in SHARES:
+            self._mount_single(name)
+        else:
+            available = list(SHARES.keys()) + list(SHARES.groups.keys()) + ['all']
+            self.fm.notify(f"Unknown share: {name}. Available: {', '.join(available)}", bad=True)
+            if SHARES.error:
+                self.fm.notify(SHARES.error, bad=True)
+
+    def _start_mount(self, share_name, share):
+        """Prepare a share and submit its mount to the worker pool.
+
+        Returns the future, or None if the share is already mounted or being
+        mounted.  share must be a private copy: the validated mount options
+        are recorded on it.  Raises ValueError for a bad profile and OSError
+        if the mount point can't be created.  The share leaves pending_mounts
+        (and is tracked, if it came up) through the share monitor as soon as
+        the mount finishes, so aborting the loader task showing it loses
+        nothing.
+        """
+        mount_point = share['mount_point']
+
+        # Check if already mounted
+        if mount_table.is_mounted(mount_point):
+            return None
+
+        if share_name in pending_mounts:
+            return None
+
+        share['profile'], share['mount_options'] = cifs_mount_options(share, SHARES.profiles)
+
+        # Create mount point if it doesn't exist
+        if not os.path.exists(mount_point):
+            os.makedirs(mount_point, mode=0o755)
+            self.fm.notify(f"Created mount point: {mount_point}")
+
+        pending_mounts.add(share_name)
+        share_monitor.start(self.fm)
+        future = share_pool.submit(run_cifs_mount, share, SHARES.settings)
+        future.add_done_callback(lambda future: share_monitor.post(
+            lambda: self._finish_mount(share_name, share, future)))
+        return future
+
+    def _finish_mount(self, share_name, share, future):
+        """UI-thread record of the outcome of a mount started by _start_mount."""
+        pending_mounts.discard(share_name)
+        if future.exception() is None and future.result()[0]:
+            self._track(share)
+
+    def _track(self, share):
+        """Track a share for cleanup and count this session as one of its users."""
+        if any(s['mount_point'] == share['mount_point'] for s in mounted_shares):
+            return
+        # Track this share for cleanup (store with expanded path)
+        mounted_shares.append(share.copy())
+        try:
+            mount_refs.acquire(share['mount_point'])
+        except OSError as e:
+            self.fm.notify(f"Could not update shared mount registry: {e}", bad=True)
+        share_monitor.start(self.fm)
+        share_monitor.touch(share['mount_point'])
+        start_indexing(share)
+
+    def _adopt(self, share):
+        """Share a mount made by another ranger session, if that's what it is.
+
+        Mounts made outside ranger (fstab, by hand) are left alone so that
+        exiting never unmounts something this session didn't set up.
+        """
+        try:
+            if mount_refs.others(share['mount_point']):
+                self._track(share)
+        except OSError:
+            pass
+
+    def _mount_single(self, share_name):
+        share = dict(SHARES[share_name])
+        mount_point = share['mount_point']
+        display_name = share['display_name']
+
+        if mount_table.is_mounted(mount_point):
+            self._adopt(share)
+            self.fm.notify(f"{display_name} is already mounted at {mount_point}")
+            self.fm.cd(mount_point)
+            return
+
+        if share_name in pending_mounts:
+            self.fm.notify(f"{display_name} is already being mounted")
+            return
+
+        try:
+            future = self._start_mount(share_name, share)
+        except ValueError as e:
+            self.fm.notify(f"Invalid mount options: {e}", bad=True)
+            return
+        except OSError as e:
+            self.fm.notify(f"Failed to create mount point: {e}", bad=True)
+            return
+
+        # Mount the share in the background and finish up on the UI thread
+        self.fm.notify(f"Mounting {display_name}...")
+
+        def on_done(results):
+            success, message = results[0]
+            if not success:
+                self.fm.notify(message, bad=True)
+                return
+            self.fm.notify(message)
+            self.fm.cd(mount_point)
+            start_warmup(self.fm, share)
+
+        self.fm.loader.add(ShareTask([future], f"Mounting {display_name}", on_done))
+
+    def _mount_on_demand(self, share_name, destination=None):
+        """Mount a share the user navigated or tab-completed into.
+
+        A tab waiting in the mount point moves on to destination once the
+        share is up; nothing moves if the user has gone elsewhere meanwhile.
+        """
+        share = dict(SHARES[share_name])
+        mount_point = share['mount_point']
+        display_name = share['display_name']
+
+        try:
+            future = self._start_mount(share_name, share)
+        except ValueError as e:
+            self.fm.notify(f"Invalid mount options: {e}", bad=True)
             return
-
-        share_name = self.arg(1).lower()
-        
-        if share_name not in SHARES:
-            self.fm.notify(f"Unknown share: {share_name}. Available: {', '.join(SHARES.keys())}", bad=True)
+        except OSError as e:
+            self.fm.notify(f"Failed to create mount point: {e}", bad=True)
             return
-            
-        share = SHARES[share_name]
-        mount_point = os.path.expanduser(share['mount_point'])
-        share_path = share['share_path']
-        display_name = share['display_name']
-        
-        # Check if already mounted
-        if os.path.ismount(mount_point):
-            self.fm.notify(f"{display_name} is already mounted at {mount_point}")
-            self.fm.cd(mount_point)
+        if future is None:
             return
-            
-        # Create mount point if it doesn't exist
-        if not os.path.exists(mount_point):
+
+        self.fm.notify(f"Mounting {display_name}...")
+
+        def on_done(results):
+            success, message = results[0]
+            if not success:
+                self.fm.notify(message, bad=True)
+                return
+            self.fm.notify(message)
+            refresh_share_views(self.fm, mount_point)
+            current = self.fm.thistab.path
+            if destination and current and path_under(current, mount_point):
+                # Re-enter even the same path: the tab's cwd is still the
+                # directory underneath the new mount
+                self.fm.cd(destination if os.path.isdir(destination) else current)
+                start_warmup(self.fm, share)
+
+        self.fm.loader.add(ShareTask([future], f"Mounting {display_name}", on_done))
+
+    def _mount_group(self, group_name, members):
+        if not members:
+            self.fm.notify(f"Share group {group_name} is empty", bad=True)
+            return
+
+        # Snapshot the definitions in case smb_shares.json changes meanwhile
+        shares = {name: dict(SHARES[name]) for name in members if name in SHARES}
+        ready = []
+        busy = []
+        failed = []
+        started = []
+        for share_name in members:
+            if share_name not in shares:
+                failed.append(f"{share_name} (unknown share)")
+                continue
+            if share_name in pending_mounts:
+                # In flight from an earlier command, which will report it
+                busy.append(share_name)
+                continue
             try:
-                os.makedirs(mount_point, mode=0o755)
-                self.fm.notify(f"Created mount point: {mount_point}")
+                future = self._start_mount(share_name, shares[share_name])
+            except ValueError as e:
+                failed.append(f"{share_name} ({e})")
+                continue
             except OSError as e:
-                self.fm.notify(f"Failed to create mount point: {e}", bad=True)
-                return
-        
-        # Mount the share
-        self.fm.notify(f"Mounting {display_name}...")
-        try:
-            result = subprocess.run([
-                'sudo', 'mount', '-t', 'cifs', 
-                '-o', 'rw,guest', 
-                share_path, mount_point
-            ], capture_output=True, text=True, timeout=30)
-            
-            if result.returncode == 0:
-                self.fm.notify(f"Successfully mounted {display_name}")
-                # Track this share for cleanup (store with expanded path)
-                share_copy = share.copy()
-                share_copy['mount_point'] = mount_point
-                mounted_shares.append(share_copy)
-                self.fm.cd(mount_point)
+                failed.append(f"{share_name} (mount point: {e})")
+                continue
+            if future is None:
+                self._adopt(shares[share_name])
+                ready.append(share_name)
             else:
-                self.fm.notify(f"Failed to mount {display_name}: {result.stderr}", bad=True)
-                
-        except subprocess.TimeoutExpired:
-            self.fm.notify(f"Mount operation timed out for {display_name}", bad=True)
-        except FileNotFoundError:
-            self.fm.notify("mount command not found. Please install cifs-utils", bad=True)
-        except Exception as e:
-            self.fm.notify(f"Error mounting {display_name}: {e}", bad=True)
+                started.append((share_name, future))
+
+        def on_done(results):
+            mounted = list(ready)
+            for (share_name, _), (success, message) in zip(started, results):
+                if success:
+                    mounted.append(share_name)
+                else:
+                    failed.append(f"{share_name} ({message})")
+
+            report = f"{group_name}: {len(mounted)}/{len(members)} shares mounted"
+            if busy:
+                report += f"; still mounting: {', '.join(busy)}"
+            if failed:
+                report += f"; failed: {', '.join(failed)}"
+            self.fm.notify(report, bad=bool(failed))
+
+            # Land in the first member that came up, in the group's order
+            for share_name in members:
+                if share_name in mounted:
+                    self.fm.cd(shares[share_name]['mount_point'])
+                    start_warmup(self.fm, shares[share_name])
+                    break
+
+        if not started:
+            on_done([])
+            return
+
+        self.fm.notify(f"Mounting {len(started)} shares from {group_name}...")
+        self.fm.loader.add(ShareTask([future for _, future in started],
+                                     f"Mounting share group {group_name}", on_done))
 
     def tab(self, tabnum):
-        # Provide tab completion for available shares
-        return [share for share in SHARES.keys() if share.startswith(self.rest(1))]
+        # Provide tab completion for available shares, groups and "all"
+        names = list(SHARES.keys()) + list(SHARES.groups.keys()) + ['all']
+        return [name for name in names if name.startswith(self.rest(1))]
 
 
 class unmount_share(Command):
@@ -235,43 +3707,68 @@ class unmount_share(Command):
         
         if share_name not in SHARES:
             self.fm.notify(f"Unknown share: {share_name}. Available: {', '.join(SHARES.keys())}", bad=True)
+            if SHARES.error:
+                self.fm.notify(SHARES.error, bad=True)
             return
             
         share = SHARES[share_name]
-        mount_point = os.path.expanduser(share['mount_point'])
+        mount_point = share['mount_point']
         share_path = share['share_path']
         display_name = share['display_name']
         
         # Check if mounted
-        if not os.path.ismount(mount_point):
+        if not mount_table.is_mounted(mount_point):
             self.fm.notify(f"{display_name} is not mounted at {mount_point}")
             return
         
-        # Unmount the share
+        # Only the last ranger session using a share unmounts it
+        try:
+            others = mount_refs.others(mount_point)
+        except OSError as e:
+            self.fm.notify(f"Could not read shared mount registry: {e}", bad=True)
+            others = 0
+        if others:
+            release_mount_ref(mount_point, lambda message: self.fm.notify(message, bad=True))
+            mounted_shares[:] = [s for s in mounted_shares if s['mount_point'] != mount_point]
+            share_monitor.last_active.pop(mount_point, None)
+            self.fm.notify(f"{display_name} is still used by {others} other ranger session(s); left mounted")
+            return
+
+        if mount_point in idle_unmounts:
+            self.fm.notify(f"{display_name} is already being unmounted")
+            return
+
+        # Unmount on the mount pool; a stalled share can take the whole
+        # timeout to let go, and the UI must not wait for it
         self.fm.notify(f"Unmounting {display_name}...")
+        idle_unmounts.add(mount_point)
+        share_monitor.start(self.fm)
+        future = share_pool.submit(run_umount, mount_point)
+        future.add_done_callback(lambda future: share_monitor.post(
+            lambda: self._finish(share_name, share, *future.result())))
+
+    def _finish(self, share_name, share, success, error):
+        """UI-thread half of the unmount."""
+        mount_point = share['mount_point']
+        display_name = share['display_name']
+        idle_unmounts.discard(mount_point)
+        if not success:
+            self.fm.notify(f"Failed to unmount {display_name}: {error}", bad=True)
+            return
+
+        self.fm.notify(f"Successfully unmounted {display_name}")
+        # Remove from tracking list
+        mounted_shares[:] = [s for s in mounted_shares if s['mount_point'] != mount_point]
+        share_monitor.last_active.pop(mount_point, None)
+        release_mount_ref(mount_point, lambda message: self.fm.notify(message, bad=True))
+
+        # Try to remove the mount point directory if it's empty
         try:
-            result = subprocess.run(['sudo', 'umount', mount_point], 
-                                  capture_output=True, text=True, timeout=30)
-            
-            if result.returncode == 0:
-                self.fm.notify(f"Successfully unmounted {display_name}")
-                # Remove from tracking list
-                mounted_shares[:] = [s for s in mounted_shares if s['mount_point'] != mount_point]
-                
-                # Try to remove the mount point directory if it's empty
-                try:
-                    os.rmdir(mount_point)
-                    self.fm.notify(f"Removed mount point directory: {mount_point}")
-                except OSError as e:
-                    # Directory not empty or other error - just log it
-                    self.fm.notify(f"Could not remove mount point directory {mount_point}: {e}")
-            else:
-                self.fm.notify(f"Failed to unmount {display_name}: {result.stderr}", bad=True)
-                
-        except subprocess.TimeoutExpired:
-            self.fm.notify(f"Unmount operation timed out for {display_name}", bad=True)
-        except Exception as e:
-            self.fm.notify(f"Error unmounting {display_name}: {e}", bad=True)
+            share_watchdog.call(mount_point, os.rmdir, mount_point)
+            self.fm.notify(f"Removed mount point directory: {mount_point}")
+        except OSError as e:
+            # Directory not empty or other error - just log it
+            self.fm.notify(f"Could not remove mount point directory {mount_point}: {e}")
 
     def tab(self, tabnum):
         # Provide tab completion for available shares
@@ -281,19 +3778,783 @@ class unmount_share(Command):
 class list_mounted_shares(Command):
     """:list_mounted_shares
 
-    List all currently mounted SMB shares.
+    Show every configured share in the pager: whether it is mounted (and
+    by this session), size, used and free space, the time a statvfs on
+    the mount and a TCP connect to the server take, and the profile and
+    kernel mount options.  Shares are checked concurrently, each within
+    its own deadline (fs_timeout for the mount, probe_timeout for the
+    server), and each row fills in as soon as its share has answered.
     """
 
     def execute(self):
-        if not mounted_shares:
-            self.fm.notify("No shares mounted in this session")
+        shares = [dict(share) for share in SHARES.values()]
+        if not shares:
+            self.fm.notify("No shares configured", bad=True)
             return
-            
-        self.fm.notify("Mounted shares in this session:")
-        for share in mounted_shares:
-            mount_point = share['mount_point']
-            display_name = share['display_name']
-            if os.path.ismount(mount_point):
-                self.fm.notify(f"  {display_name} at {mount_point}")
+
+        settings = SHARES.settings
+        rows = [None] * len(shares)
+        pager = self.fm.ui.open_pager()
+        shown = [self._render(shares, rows)]
+        pager.set_source(shown[0])
+
+        def on_result(index, status):
+            rows[index] = status
+            # Leave the pager alone once the user has moved on from this view
+            if pager.visible and pager.source is shown[0]:
+                shown[0] = self._render(shares, rows)
+                pager.set_source(shown[0])
+                pager.need_redraw = True
+
+        futures = [share_pool.submit(share_status, share, settings) for share in shares]
+        self.fm.loader.add(ShareTask(futures, "Checking shares", lambda results: None,
+                                     on_result=on_result))
+
+    @staticmethod
+    def _render(shares, rows):
+        tracked = {share['mount_point'] for share in mounted_shares}
+        lines = [f"{'Share':<24} {'State':<16} {'Size':>8} {'Used':>8} {'Free':>8} {'Use%':>5}"
+                 f" {'FS':>8} {'Server':>8}", '']
+        for share, status in zip(shares, rows):
+            name = share['display_name'][:24]
+            if status is None:
+                lines.append(f"{name:<24} checking...")
+                lines.append('')
+                continue
+
+            if status['stalled']:
+                state = 'not responding'
+            elif not status['mounted']:
+                state = 'not mounted'
+            elif share['mount_point'] in tracked:
+                state = 'mounted (here)'
+            else:
+                state = 'mounted'
+            if status['total']:
+                used, free = status['used'], status['free']
+                # Like df: the share of the space available to us that is in use
+                percent = 100 * used / (used + free) if used + free else 0
+                space = (f"{format_size(status['total']):>8} {format_size(used):>8}"
+                         f" {format_size(free):>8} {percent:>4.0f}%")
+            else:
+                space = f"{'-':>8} {'-':>8} {'-':>8} {'-':>5}"
+            fs_ms = f"{status['fs_ms']:.1f}ms" if status['fs_ms'] is not None else '-'
+            net_ms = f"{status['net_ms']:.1f}ms" if status['net_ms'] is not None else 'down'
+            lines.append(f"{name:<24} {state:<16} {space} {fs_ms:>8} {net_ms:>8}")
+
+            tracked_share = next((s for s in mounted_shares
+                                  if s['mount_point'] == share['mount_point']), {})
+            details = f"    {share['mount_point']}  ({share['share_path']})"
+            if status['options']:
+                profile = tracked_share.get('profile') or share.get('profile') or 'default'
+                details += f"  [{profile}: {status['options']}]"
+            if status['error']:
+                details += f"  error: {status['error']}"
+            lines.append(details)
+        return lines
+
+
+class bench_share(Command):
+    """:bench_share <share_name|path>
+    :bench_share history [share_name]
+
+    Benchmark a mounted share (or any directory, such as a tmpfs) in the
+    background: sequential read/write MB/s, small-file create/stat/unlink
+    ops/s, and readdir latency on a directory of bench_small_files entries.
+
+    Every run is appended to smb_bench.jsonl in ranger's data directory,
+    together with the share's mount profile and options, so runs can be
+    compared across profiles.  "history" shows past runs in the pager.
+
+    Examples:
+    :bench_share localmedia
+    :bench_share /dev/shm
+    :bench_share history localmedia
+    """
+
+    def execute(self):
+        if self.arg(1) == 'history':
+            self._show_history(self.arg(2).lower() or None)
+            return
+        if not self.arg(1):
+            self.fm.notify("Please specify a share name or path", bad=True)
+            return
+
+        target = self.arg(1)
+        if target.lower() in SHARES:
+            share_name = target.lower()
+            root = SHARES[share_name]['mount_point']
+            if not mount_table.is_mounted(root):
+                self.fm.notify(f"{SHARES[share_name]['display_name']} is not mounted", bad=True)
+                return
+        else:
+            root = os.path.abspath(os.path.expanduser(target))
+            try:
+                is_dir = share_watchdog.call(root, os.path.isdir, root)
+            except ShareStalled as e:
+                self.fm.notify(f"Cannot benchmark {root}: {e.strerror}", bad=True)
+                return
+            if not is_dir:
+                self.fm.notify(f"Not a share or directory: {target}", bad=True)
+                return
+            share_name, _ = share_for_path(root)
+
+        # Record what the share is mounted with so profiles can be compared
+        mounted = next((s for s in mounted_shares if s['mount_point'] == root), {})
+        settings = SHARES.settings
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'share': share_name,
+            'path': root,
+            'profile': mounted.get('profile'),
+            'mount_options': mounted.get('mount_options'),
+            'size_mb': settings['bench_size_mb'],
+            'small_files': settings['bench_small_files'],
+        }
+        history_path = os.path.join(share_datadir(), 'smb_bench.jsonl')
+
+        def run():
+            try:
+                with share_in_use(root):
+                    return benchmark_path(root, record['size_mb'], record['small_files']), None
+            except OSError as e:
+                return None, e
+
+        def on_done(results):
+            metrics, error = results[0]
+            if error is not None:
+                self.fm.notify(f"Benchmark of {root} failed: {error}", bad=True)
+                return
+            record.update(metrics)
+            previous = self._load_history(history_path, share_name, root)
+            try:
+                os.makedirs(os.path.dirname(history_path), exist_ok=True)
+                with open(history_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                self.fm.notify(f"Could not save benchmark history: {e}", bad=True)
+            summary = f"{share_name or root}: {format_bench(record)}"
+            if previous:
+                last = previous[-1]
+                summary += (f" (last run: read {last['read_mb_s']:.1f},"
+                            f" write {last['write_mb_s']:.1f} MB/s)")
+            self.fm.notify(summary)
+
+        self.fm.notify(f"Benchmarking {root}...")
+        self.fm.loader.add(ShareTask([job_pool.submit(run)], f"Benchmarking {root}", on_done),
+                           append=True)
+
+    @staticmethod
+    def _load_history(history_path, share_name=None, root=None):
+        records = []
+        if not os.path.exists(history_path):
+            return records
+        with open(history_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if share_name and record.get('share') != share_name:
+                    continue
+                if not share_name and root and record.get('path') != root:
+                    continue
+                records.append(record)
+        return records
+
+    def _show_history(self, share_name):
+        records = self._load_history(os.path.join(share_datadir(), 'smb_bench.jsonl'), share_name)
+        if not records:
+            self.fm.notify("No benchmark history yet")
+            return
+        lines = []
+        for record in records:
+            lines.append(f"{record['time']}  {record.get('share') or record['path']}"
+                         f"  [{record.get('profile') or 'default'}: {record.get('mount_options') or '-'}]")
+            lines.append(f"    {format_bench(record)}")
+        pager = self.fm.ui.open_pager()
+        pager.set_source(lines)
+
+    def tab(self, tabnum):
+        names = list(SHARES.keys()) + ['history']
+        return [name for name in names if name.startswith(self.rest(1))]
+
+
+class fetch_from_share(Command):
+    """:fetch_from_share [-bv] [destination]
+
+    Copy the selected files and folders from a mounted share to local
+    disk (fetch_dir by default) through the transfer queue (see
+    :transfers).  Each file is copied as fetch_chunk_mb byte ranges on
+    fetch_workers threads, with copy_file_range where the kernel
+    supports it between the two filesystems and pread/pwrite otherwise.
+    Interrupted files resume where they stopped; finished copies are
+    checked against the source's size and mtime, and files already
+    fetched are skipped.  -b queues the copies as background transfers,
+    which only get bandwidth that foreground ones leave over.  -v (or
+    the transfer_verify setting) checks every copy against the source
+    by checksum afterwards.
+
+    Examples:
+    :fetch_from_share
+    :fetch_from_share -b ~/Videos
+    :fetch_from_share -v ~/Archives
+    """
+
+    def execute(self):
+        flags = transfer_flags(self)
+        dest = self.rest(1)
+        dest_dir = os.path.abspath(os.path.expanduser(dest or SHARES.settings['fetch_dir']))
+        sources = [f.path for f in self.fm.thistab.get_selection()]
+        if not sources:
+            self.fm.notify("Nothing selected to fetch", bad=True)
+            return
+
+        share_name, share = share_for_path(sources[0])
+        for source in sources:
+            name, _ = share_for_path(source)
+            if share is None or name != share_name:
+                self.fm.notify(f"Not on a single configured share: {source}", bad=True)
+                return
+        if not mount_table.is_mounted(share['mount_point']):
+            self.fm.notify(f"{share['display_name']} is not mounted", bad=True)
+            return
+        if share['mount_point'] in share_watchdog.stalled:
+            self.fm.notify(f"{share['display_name']} is not responding", bad=True)
+            return
+
+        share_monitor.start(self.fm)
+        queue_transfers(self.fm, sources, dest_dir, share_name, flags,
+                        f"from {share['display_name']} to {dest_dir}")
+
+    def tab(self, tabnum):
+        return self._tab_directory_content()
+
+
+class push_to_share(Command):
+    """:push_to_share [-bv] <share_name>[/folder]
+
+    Copy the selected local files and folders to a folder on a mounted
+    share through the transfer queue (see :transfers), with the same
+    chunked, resumable and verified copy as :fetch_from_share.  -b queues
+    the copies as background transfers, and -v checks them by checksum.
+
+    Examples:
+    :push_to_share media/incoming
+    :push_to_share -bv backup
+    """
+
+    def execute(self):
+        flags = transfer_flags(self)
+        target = self.arg(1)
+        share_name, _, folder = target.partition('/')
+        share = SHARES.get(share_name.lower())
+        if share is None:
+            self.fm.notify(f"Unknown share: {share_name}", bad=True)
+            return
+        sources = [f.path for f in self.fm.thistab.get_selection()]
+        if not sources:
+            self.fm.notify("Nothing selected to push", bad=True)
+            return
+        if not mount_table.is_mounted(share['mount_point']):
+            self.fm.notify(f"{share['display_name']} is not mounted", bad=True)
+            return
+        if share['mount_point'] in share_watchdog.stalled:
+            self.fm.notify(f"{share['display_name']} is not responding", bad=True)
+            return
+
+        dest_dir = os.path.normpath(os.path.join(share['mount_point'], folder))
+        if not path_under(dest_dir, share['mount_point']):
+            self.fm.notify(f"Not a folder on {share['display_name']}: {folder}", bad=True)
+            return
+        share_monitor.start(self.fm)
+        queue_transfers(self.fm, sources, dest_dir, share['name'], flags,
+                        f"to {share['display_name']}/{folder}")
+
+    def tab(self, tabnum):
+        names = list(SHARES.keys())
+        word = self.arg(tabnum) if tabnum else self.rest(1)
+        prefix = self.line[:len(self.line) - len(word)]
+        return [prefix + name for name in names if name.startswith(word)]
+
+
+def transfer_flags(command):
+    """Consume leading -b/-v options of a copy command; returns {'foreground': ..., 'verify': ...}."""
+    flags = {'foreground': True, 'verify': SHARES.settings['transfer_verify']}
+    while command.arg(1).startswith('-') and len(command.arg(1)) > 1:
+        letters = command.arg(1)[1:]
+        flags['foreground'] = flags['foreground'] and 'b' not in letters
+        flags['verify'] = flags['verify'] or 'v' in letters
+        command.shift()
+    return flags
+
+
+def queue_transfers(fm, sources, dest_dir, share_name, flags, description):
+    """Queue copies of sources into dest_dir and report when they are done."""
+    started = time.monotonic()
+
+    def on_finished(jobs):
+        report, failed = transfer_report(jobs, started)
+        fm.notify(f"Copied {report} {description}", bad=failed)
+        refresh_share_views(fm, dest_dir)
+
+    def enqueue():
+        pairs = expand_sources(sources, dest_dir)
+        if not pairs:
+            share_monitor.post(lambda: fm.notify("No files to copy", bad=True))
+            return
+        transfer_queue.add(pairs, share_name, flags['foreground'], on_finished, flags['verify'])
+        share_monitor.post(lambda: fm.notify(f"Queued {len(pairs)} file(s) {description}"))
+
+    # Walking folders on a share can take a while, so do it off the UI thread
+    job_pool.submit(enqueue)
+
+
+class transfers(Command):
+    """:transfers [pause|resume|prio <id>... | all] | clear
+
+    Without arguments, show the transfer queue in the pager with each
+    job's state ("verify" while a copy is checked against its source),
+    progress and throughput, refreshed every second while the pager
+    shows it.  pause stops jobs after the piece being copied
+    (their progress is kept), resume restarts paused and failed jobs,
+    prio moves jobs to the front and gives them foreground bandwidth,
+    and clear forgets finished and failed jobs.  Transfers run at most
+    transfer_share_concurrency at a time per share and share
+    transfer_bandwidth_mb MiB/s between them (0 = no limit).
+
+    Examples:
+    :transfers
+    :transfers pause all
+    :transfers prio 4 5
+    """
+
+    actions = ('pause', 'resume', 'prio', 'clear')
+
+    def execute(self):
+        share_monitor.start(self.fm)
+        transfer_queue.start()
+        action = self.arg(1)
+        if not action:
+            self._show()
+            return
+        if action not in self.actions:
+            self.fm.notify(f"Unknown transfers action: {action}", bad=True)
+            return
+        if action == 'clear':
+            transfer_queue.clear()
+            return
+
+        words = self.args[2:]
+        if not words:
+            self.fm.notify(f"Usage: transfers {action} <id>... | all", bad=True)
+            return
+        if words == ['all']:
+            ids = None
+        else:
+            try:
+                ids = {int(word) for word in words}
+            except ValueError:
+                self.fm.notify("Transfer ids are numbers (see :transfers)", bad=True)
+                return
+        if action == 'pause':
+            transfer_queue.pause(ids)
+        elif action == 'resume':
+            transfer_queue.resume(ids)
+        else:
+            transfer_queue.prioritize(ids if ids is not None else
+                                      {job['id'] for job in transfer_queue.jobs})
+
+    def _show(self):
+        pager = self.fm.ui.open_pager()
+        shown = [self._render(transfer_queue.snapshot())]
+        pager.set_source(shown[0])
+
+        def refresh():
+            # Leave the pager alone once the user has moved on from this view
+            if not (pager.visible and pager.source is shown[0]):
+                return False
+            shown[0] = self._render(transfer_queue.snapshot())
+            pager.set_source(shown[0])
+            pager.need_redraw = True
+            return True
+
+        def refresh_loop():
+            visible = [True]
+            while visible[0]:
+                time.sleep(1)
+                done = threading.Event()
+
+                def step():
+                    visible[0] = refresh()
+                    done.set()
+                share_monitor.post(step)
+                done.wait()
+
+        threading.Thread(target=refresh_loop, name='ranger-smb-transfers-view', daemon=True).start()
+
+    @staticmethod
+    def _render(jobs):
+        limit = SHARES.settings['transfer_bandwidth_mb']
+        running = [job for job in jobs if job['state'] == 'running']
+        total_rate = sum(job['rate'] or 0 for job in running)
+        lines = [f"{len(running)} running, {sum(job['state'] == 'queued' for job in jobs)} queued,"
+                 f" {format_size(total_rate)}/s"
+                 + (f" (limit {limit} MiB/s)" if limit else ''), '',
+                 f"{'Id':>4} {'State':<8} {'Share':<16} {'Done':>14} {'%':>4} {'Rate':>9}  File", '']
+        for job in jobs:
+            size, done = job['size'], job['done']
+            if size:
+                amount = f"{format_size(done)}/{format_size(size)}"
+                percent = f"{min(100, 100 * done / size):.0f}%"
+            else:
+                amount, percent = '-', '-'
+            rate = f"{format_size(job['rate'])}/s" if job['rate'] is not None else ''
+            state = 'verify' if job['state'] == 'running' and job.get('phase') == 'verify' else job['state']
+            state += '*' if job['foreground'] else ''
+            lines.append(f"{job['id']:>4} {state:<8} {job['share'][:16]:<16} {amount:>14}"
+                         f" {percent:>4} {rate:>9}  {job['source']}")
+            details = f"{'':>33}-> {job['target']}"
+            if job['error']:
+                details += f"  error: {job['error']}"
+            lines.append(details)
+        if not jobs:
+            lines.append("No transfers")
+        lines += ['', "* foreground"]
+        return lines
+
+    def tab(self, tabnum):
+        return [f"transfers {action}" for action in self.actions
+                if action.startswith(self.rest(1))]
+
+
+class mirror_share(Command):
+    """:mirror_share [-c] <share_name> <subpath> <destination>
+
+    Mirror a folder on a share one way into a local folder.  Only files
+    that are new or changed on the share (by size and mtime, against a
+    manifest of what earlier runs copied) are copied, mirror_workers at a
+    time with the same resumable chunked copy as :fetch_from_share, and
+    within the transfer_bandwidth_mb cap.  Local files that were changed
+    since they were mirrored are left alone and reported, and files
+    deleted from the share are kept.  With mirror_hash set, a SHA-256 of
+    every copy is recorded, and -c re-hashes the local copies and copies
+    again any that no longer match.
+
+    Examples:
+    :mirror_share downloads tv ~/Media/tv
+    :mirror_share -c downloads / ~/Mirror/downloads
+    """
+
+    def execute(self):
+        check = self.arg(1) == '-c'
+        args = self.args[2:] if check else self.args[1:]
+        if len(args) < 3:
+            self.fm.notify("Usage: mirror_share [-c] <share_name> <subpath> <destination>", bad=True)
+            return
+        share_name, subpath, dest = args[0].lower(), args[1], ' '.join(args[2:])
+        share = SHARES.get(share_name)
+        if share is None:
+            self.fm.notify(f"Unknown share: {args[0]}", bad=True)
+            return
+        source = os.path.normpath(os.path.join(share['mount_point'], subpath.lstrip('/')))
+        dest = os.path.abspath(os.path.expanduser(dest))
+        if not path_under(source, share['mount_point']):
+            self.fm.notify(f"Not a folder on {share['display_name']}: {subpath}", bad=True)
+            return
+        if not mount_table.is_mounted(share['mount_point']):
+            self.fm.notify(f"{share['display_name']} is not mounted", bad=True)
+            return
+        if share['mount_point'] in share_watchdog.stalled:
+            self.fm.notify(f"{share['display_name']} is not responding", bad=True)
+            return
+        if path_under(dest, share['mount_point']):
+            self.fm.notify("The mirror destination must be outside the share", bad=True)
+            return
+
+        settings = SHARES.settings
+        mirror = ShareMirror(share_name, source, dest)
+        label = f"{share['display_name']}/{subpath.strip('/')}"
+
+        def run():
+            try:
+                with share_in_use(mirror.source):
+                    return mirror.run(settings, check)
+            except OSError as e:
+                return e
+
+        def on_done(results):
+            summary = results[0]
+            if isinstance(summary, OSError):
+                self.fm.notify(f"Mirror of {label} failed: {summary.strerror or summary}", bad=True)
+                return
+            mib = summary['bytes'] / (1 << 20)
+            report = (f"Mirrored {label} in {summary['seconds']:.1f}s: {summary['files']} file(s),"
+                      f" {summary['copied']} copied ({mib:.1f} MiB), {summary['unchanged']} unchanged")
+            if summary['gone']:
+                report += f", {summary['gone']} gone from the share (kept)"
+            if summary['conflicts']:
+                report += (f"; {len(summary['conflicts'])} changed locally and left alone"
+                           f" ({', '.join(summary['conflicts'][:3])})")
+            if summary['failed']:
+                report += f"; failed: {', '.join(summary['failed'])}"
+            self.fm.notify(report, bad=bool(summary['failed']))
+            refresh_share_views(self.fm, dest)
+
+        self.fm.notify(f"Mirroring {label} to {dest}...")
+        # Appended, so directory loads queued meanwhile aren't held up behind it
+        self.fm.loader.add(ShareTask([job_pool.submit(run)], f"Mirroring {label}", on_done),
+                           append=True)
+
+    def tab(self, tabnum):
+        if len(self.args) <= 2 or (self.arg(1) == '-c' and len(self.args) <= 3):
+            word = self.args[-1] if len(self.args) > 1 else ''
+            prefix = self.line[:len(self.line) - len(word)]
+            return [prefix + name for name in SHARES.keys() if name.startswith(word)]
+        return None
+
+
+class share_find(Command):
+    """:share_find [-l] <query>
+
+    Find files and folders on any share by name, from the indexes built
+    in the background after mounting, and jump to the best match (names
+    containing the query first, then the shortest paths).  With -l, list
+    every match in the pager instead.  Every word of the query must
+    appear somewhere in the path.
+
+    Examples:
+    :share_find blade runner
+    :share_find -l .srt
+    """
+
+    def execute(self):
+        listing = self.arg(1) == '-l'
+        if listing:
+            self.shift()
+        query = self.rest(1).strip()
+        if not query:
+            self.fm.notify("Please specify what to look for", bad=True)
+            return
+
+        hits = []
+        for name, share in SHARES.items():
+            index = ShareIndex(name)
+            if not os.path.exists(index.path):
+                continue
+            try:
+                rows = index.search(query)
+            except sqlite3.Error as e:
+                self.fm.notify(f"Could not search the index of {share['display_name']}: {e}", bad=True)
+                continue
+            for path, size, mtime_ns, is_dir in rows:
+                hits.append((os.path.join(share['mount_point'], path), size, mtime_ns, is_dir))
+        if not hits:
+            self.fm.notify(f"No indexed path matches {query}", bad=True)
+            return
+
+        words = query.lower().split()
+        hits.sort(key=lambda hit: (not all(word in os.path.basename(hit[0]).lower() for word in words),
+                                   len(hit[0]), hit[0]))
+
+        if listing:
+            lines = [f"{len(hits)} match(es) for {query}:"]
+            for path, size, mtime_ns, is_dir in hits:
+                when = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime_ns / 1e9))
+                size_text = 'dir' if is_dir else f"{size / (1 << 20):.1f} MiB"
+                lines.append(f"  {when}  {size_text:>11}  {path}")
+            pager = self.fm.ui.open_pager()
+            pager.set_source(lines)
+            return
+
+        path, _, _, is_dir = hits[0]
+        if is_dir:
+            self.fm.cd(path)
+        else:
+            self.fm.select_file(path)
+        if len(hits) > 1:
+            self.fm.notify(f"{path} (best of {len(hits)}; :share_find -l {query} lists them all)")
+
+
+# Paths :share_dupes marked as redundant copies, for :share_dupes trash
+duplicate_paths = []
+
+
+class share_dupes(Command):
+    """:share_dupes [share_name|group_name ...]
+    :share_dupes trash
+
+    Find files with identical content across the mounted shares (or
+    the given shares and groups) in the background.  Files of at least
+    dupes_min_mb are grouped by size from the share indexes, or a walk
+    of shares without one, then compared by a hash of their ends and
+    finally a full hash, on dupes_workers threads.  Every set is
+    listed in the pager with the copy to keep first: the one on the
+    share named earliest, then the shortest path.  The other copies are
+    marked in ranger, so you can look them over and unmark any you want
+    to keep.  ":share_dupes trash" asks for confirmation and then moves
+    the copies still marked to the trash, like :trash.
+
+    Examples:
+    :share_dupes
+    :share_dupes downloads savedmedia
+    """
+
+    def execute(self):
+        if self.arg(1) == 'trash':
+            self._trash()
+            return
+
+        names = []
+        for word in self.args[1:]:
+            word = word.lower()
+            if word in SHARES.groups:
+                names.extend(SHARES.groups[word])
+            elif word in SHARES:
+                names.append(word)
             else:
-                self.fm.notify(f"  {display_name} at {mount_point} (not mounted)", bad=True)
+                self.fm.notify(f"Unknown share or group: {word}", bad=True)
+                return
+        if not names:
+            names = [name for name, share in SHARES.items() if mount_table.is_mounted(share['mount_point'])]
+        shares = []
+        for name in dict.fromkeys(names):
+            share = SHARES[name]
+            if not mount_table.is_mounted(share['mount_point']):
+                self.fm.notify(f"{share['display_name']} is not mounted", bad=True)
+                return
+            if share['mount_point'] in share_watchdog.stalled:
+                self.fm.notify(f"{share['display_name']} is not responding", bad=True)
+                return
+            shares.append(share)
+        if not shares:
+            self.fm.notify("No mounted shares to search", bad=True)
+            return
+
+        settings = SHARES.settings
+        label = ', '.join(share['display_name'] for share in shares)
+
+        def run():
+            try:
+                with share_in_use(*(share['mount_point'] for share in shares)):
+                    return find_duplicates(shares, settings)
+            except Exception as e:
+                # Report anything, so the task ends cleanly instead of failing the loader
+                return e
+
+        def on_done(results):
+            if isinstance(results[0], Exception):
+                self.fm.notify(f"Looking for duplicates failed: {results[0]}", bad=True)
+                return
+            sets, stats = results[0]
+            self._show(sets, stats, label)
+
+        self.fm.notify(f"Looking for duplicates on {label}...")
+        self.fm.loader.add(ShareTask([job_pool.submit(run)], f"Finding duplicates on {label}",
+                                     on_done), append=True)
+
+    def _show(self, sets, stats, label):
+        extras = [path for _, paths in sets for path in paths[1:]]
+        wasted = sum(size * (len(paths) - 1) for size, paths in sets)
+        for path in extras:
+            directory = self.fm.get_directory(os.path.dirname(path))
+            item = next((item for item in directory.files or () if item.path == path), None)
+            if item is not None:
+                directory.mark_item(item, True)
+            elif path not in (item.path for item in directory.marked_items):
+                # Ranger re-applies marks by path when it loads the folder
+                directory.marked_items.append(File(path))
+        duplicate_paths[:] = extras
+
+        phases = ', '.join(f"{name[:-3]} {ms / 1000:.1f}s" for name, ms in stats['phases'].items())
+        summary = (f"{len(sets)} duplicate set(s), {len(extras)} redundant copies"
+                   f" using {format_size(wasted)}")
+        lines = [f"Duplicates on {label}: {summary}",
+                 f"{stats['candidates']} candidate(s) by size, {stats['hashed_mb']:.1f} MiB hashed"
+                 f" in {stats['seconds']:.1f}s ({phases})",
+                 "The first file of each set is kept; the others are marked for :share_dupes trash.", '']
+        for size, paths in sets:
+            lines.append(f"{format_size(size)} x {len(paths)}")
+            lines.append(f"  keep  {paths[0]}")
+            lines.extend(f"  dupe  {path}" for path in paths[1:])
+            lines.append('')
+        pager = self.fm.ui.open_pager()
+        pager.set_source(lines)
+        self.fm.notify(f"{summary}; marked")
+
+    def _trash(self):
+        marked = set()
+        for directory in {os.path.dirname(path) for path in duplicate_paths}:
+            directory = self.fm.directories.get(directory)
+            if directory is not None:
+                marked.update(item.path for item in directory.marked_items)
+        paths = [path for path in duplicate_paths if path in marked]
+        if not paths:
+            self.fm.notify("No marked duplicates left (run :share_dupes first)", bad=True)
+            return
+
+        def answer(key):
+            if key in ('y', 'Y'):
+                del duplicate_paths[:]
+                # Straight to rifle's trash rule: a console line would expand
+                # ranger macros such as %s inside the file names
+                self.fm.execute_file(paths, label='trash')
+
+        self.fm.ui.console.ask(f"Move {len(paths)} marked duplicate(s) to the trash? (y/N)",
+                               answer, ('n', 'N', 'y', 'Y'))
+
+    def tab(self, tabnum):
+        names = list(SHARES.keys()) + list(SHARES.groups.keys()) + ['trash']
+        word = self.args[-1] if len(self.args) > 1 and not self.line.endswith(' ') else ''
+        prefix = self.line[:len(self.line) - len(word)]
+        return [prefix + name for name in names if name.startswith(word)]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+class share_stats(Command):
+    """:share_stats [share_name]
+
+    Show timing statistics for share operations recorded in
+    smb_events.jsonl: count, failures and p50/p95/max of the total time
+    and of each phase (probe, spawn, kernel mount/umount, first readdir),
+    per share and operation.
+    """
+
+    phases = ('total_ms', 'probe_ms', 'spawn_ms', 'mount_ms', 'umount_ms', 'readdir_ms')
+
+    def execute(self):
+        wanted = self.arg(1).lower() or None
+        groups = {}
+        for event in share_telemetry.load():
+            if wanted and event.get('share') != wanted:
+                continue
+            groups.setdefault((event.get('share'), event.get('op')), []).append(event)
+
+        if not groups:
+            self.fm.notify("No share operations recorded yet")
+            return
+
+        lines = [f"Share operation timings (ms) from {share_telemetry.path()}", ""]
+        for (share, op), events in sorted(groups.items(), key=lambda item: str(item[0])):
+            failures = [e for e in events if e.get('error_class')]
+            lines.append(f"{share} {op}: {len(events)} runs, {len(failures)} failed")
+            for phase in self.phases:
+                values = [e[phase] for e in events if phase in e]
+                if values:
+                    lines.append(f"    {phase[:-3]:<8} p50 {percentile(values, 0.5):>9.1f}"
+                                 f"  p95 {percentile(values, 0.95):>9.1f}  max {max(values):>9.1f}")
+            error_classes = sorted({e['error_class'] for e in failures})
+            if error_classes:
+                lines.append(f"    errors: {', '.join(error_classes)}")
+            lines.append("")
+
+        pager = self.fm.ui.open_pager()
+        pager.set_source(lines)
+
+    def tab(self, tabnum):
+        return [share for share in SHARES.keys() if share.startswith(self.rest(1))]
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Privileged mount helper for ranger's SMB share commands.
+
+commands.py starts this once per ranger session via sudo when the
+"mount_helper" setting is enabled, instead of forking sudo for every
+mount and unmount.  It takes no arguments: the calling user comes from
+SUDO_UID, and it listens on /run/ranger-smb/<uid>.sock, in a directory
+only root can write to, owned by that user.  It serves exactly one
+connection (the ranger session that started it) and exits when that
+connection closes.
+
+Requests and responses are JSON lines, so several operations can be in
+flight on the one connection:
+
+    {"id": 1, "argv": ["mount", "-t", "cifs", "-o", "rw,guest", "//host/share", "/home/me/mnt/share"], "timeout": 30}
+    {"id": 1, "returncode": 0, "stderr": ""}
+
+Only CIFS mounts and unmounts of the share_path/mount_point pairs listed
+in the root-owned /etc/ranger/smb_shares.json are run, only on mount
+points inside the calling user's home directory, and always with
+nosuid,nodev; anything else is refused.
+"""
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import pwd
+import re
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+
+# CIFS options commands.py may send (see BASE_MOUNT_OPTIONS and CIFS_OPTION_RULES)
+ALLOWED_OPTIONS = {
+    "rw", "guest", "rsize", "wsize", "cache", "actimeo", "acregmax", "acdirmax",
+    "echo_interval", "vers", "nosharesock", "noserverino", "nobrl", "hard", "soft",
+}
+
+OPTION_VALUE = re.compile(r'^[A-Za-z0-9._]+$')
+
+MAX_TIMEOUT = 120
+
+# Fixed locations, so that nothing a caller passes decides what root reads or replaces
+CONFIG_PATH = '/etc/ranger/smb_shares.json'
+SOCKET_DIR = '/run/ranger-smb'
+
+# Always added to mounts: the server is not trusted with setuid files or devices
+FORCED_OPTIONS = 'nosuid,nodev'
+
+
+def inside_home(path, home):
+    """True if path, with symlinks resolved, lies strictly below home."""
+    home = os.path.realpath(home)
+    return os.path.realpath(path).startswith(home.rstrip('/') + '/')
+
+
+def open_below_home(path, home):
+    """Open the directory path inside home as an O_PATH fd, following no symlinks.
+
+    Home is resolved once; its ancestors belong to root.  Every component
+    below it is the user's, so each is opened relative to the last with
+    O_NOFOLLOW: swapping one for a symlink makes the open fail instead of
+    redirecting it.  Raises OSError if path is outside home or can't be
+    opened that way.
+    """
+    path = os.path.normpath(path)
+    home_real = os.path.realpath(home)
+    for prefix in (home.rstrip('/'), home_real.rstrip('/')):
+        if path.startswith(prefix + '/'):
+            names = path[len(prefix) + 1:].split('/')
+            break
+    else:
+        raise OSError(errno.EPERM, "not inside " + home, path)
+    flags = os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    fd = os.open(home_real, flags)
+    try:
+        for name in names:
+            if name in ('', '.', '..'):
+                raise OSError(errno.EPERM, "unexpected path component", path)
+            next_fd = os.open(name, flags, dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+        # The directory actually opened, not the name it was asked for
+        if not inside_home(f"/proc/self/fd/{fd}", home_real):
+            raise OSError(errno.EPERM, "not inside " + home, path)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def cifs_mount_points():
+    """Mount points of the CIFS filesystems currently mounted."""
+    mount_points = set()
+    with open('/proc/self/mounts', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] in ('cifs', 'smb3'):
+                # Spaces and the like are octal escapes in /proc/mounts
+                mount_points.add(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1]))
+    return mount_points
+
+
+def load_whitelist(home):
+    """Return {mount_point: share_path} for the shares in CONFIG_PATH below home.
+
+    The config must be owned by root and writable by nobody else, or
+    nothing is allowed.
+    """
+    try:
+        with open(CONFIG_PATH, 'r') as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid != 0 or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return {}
+            shares = json.load(f).get("shares", {})
+    except (OSError, ValueError):
+        return {}
+
+    whitelist = {}
+    for entry in shares.values():
+        try:
+            mount_point = entry['mount_point']
+            if mount_point == '~' or mount_point.startswith('~/'):
+                mount_point = home + mount_point[1:]
+            mount_point = os.path.normpath(mount_point)
+            if inside_home(mount_point, home):
+                whitelist[mount_point] = entry['share_path']
+        except (KeyError, TypeError, AttributeError):
+            continue
+    return whitelist
+
+
+def check_options(options):
+    for option in options.split(','):
+        key, _, value = option.partition('=')
+        if key not in ALLOWED_OPTIONS:
+            return f"option {key!r} not allowed"
+        if value and not OPTION_VALUE.match(value):
+            return f"bad value for {key}"
+    return None
+
+
+def check_argv(argv, whitelist, home):
+    """Return (command to run, fd, None) for an allowed mount/umount, else (None, None, reason).
+
+    A mount point is opened with open_below_home() and the mount goes onto
+    /proc/self/fd/<fd>, so it lands on the very directory that was
+    checked, whatever happens to the path meanwhile.  fd (None for
+    umounts) must be passed to the command and closed afterwards.
+    """
+    if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+        return None, None, "malformed request"
+
+    if len(argv) == 7 and argv[:4] == ['mount', '-t', 'cifs', '-o']:
+        options, share_path, mount_point = argv[4:]
+        if whitelist.get(os.path.normpath(mount_point)) != share_path:
+            return None, None, f"{share_path} on {mount_point} is not a configured share"
+        reason = check_options(options)
+        if reason:
+            return None, None, reason
+        try:
+            fd = open_below_home(mount_point, home)
+        except OSError as e:
+            return None, None, f"{mount_point} is not a directory inside {home} ({e.strerror})"
+        return (['mount', '--no-canonicalize', '-t', 'cifs', '-o', f"{options},{FORCED_OPTIONS}",
+                 share_path, f"/proc/self/fd/{fd}"], fd, None)
+
+    if argv[:1] == ['umount'] and argv[1:-1] in ([], ['-l']):
+        if os.path.normpath(argv[-1]) not in whitelist:
+            return None, None, f"{argv[-1]} is not a configured mount point"
+        # Stat-ing the mount point itself can hang on a dead server, so only
+        # its parent is resolved and the result must be a CIFS mount as is
+        parent, name = os.path.split(os.path.normpath(argv[-1]))
+        mount_point = os.path.join(os.path.realpath(parent), name)
+        if not inside_home(parent, home) and os.path.realpath(parent) != os.path.realpath(home):
+            return None, None, f"{argv[-1]} is not inside {home}"
+        if mount_point not in cifs_mount_points():
+            return None, None, f"{argv[-1]} is not a CIFS mount"
+        return ['umount', '--no-canonicalize'] + argv[1:-1] + [mount_point], None, None
+
+    return None, None, "only CIFS mount and umount are allowed"
+
+
+def check_timeout(value):
+    """Return the timeout in seconds a request asked for, capped at MAX_TIMEOUT, or None if invalid."""
+    if value is None:
+        return MAX_TIMEOUT
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if not value > 0:  # Also false for NaN
+        return None
+    return min(float(value), MAX_TIMEOUT)
+
+
+def handle(request, home):
+    response = {'id': request.get('id')}
+    timeout = check_timeout(request.get('timeout'))
+    if timeout is None:
+        response.update(returncode=1, stderr="denied by mount helper: bad timeout")
+        return response
+    argv, fd, reason = check_argv(request.get('argv'), load_whitelist(home), home)
+    if reason:
+        response.update(returncode=1, stderr=f"denied by mount helper: {reason}")
+        return response
+
+    try:
+        result = subprocess.run(argv, capture_output=True, text=True, timeout=timeout,
+                                pass_fds=() if fd is None else (fd,))
+    except subprocess.TimeoutExpired:
+        response['error'] = 'timeout'
+    except OSError as e:
+        response.update(returncode=127, stderr=str(e))
+    else:
+        response.update(returncode=result.returncode, stderr=result.stderr)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return response
+
+
+def socket_dir():
+    """Create SOCKET_DIR if needed and make sure only root can write to it."""
+    try:
+        os.mkdir(SOCKET_DIR, 0o755)
+    except FileExistsError:
+        pass
+    st = os.lstat(SOCKET_DIR)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != 0
+            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise OSError(f"{SOCKET_DIR} must be a directory only root can write to")
+    return SOCKET_DIR
+
+
+def serve(uid):
+    home = pwd.getpwuid(uid).pw_dir
+    socket_path = os.path.join(socket_dir(), f"{uid}.sock")
+
+    # Another session of the same user may be starting its helper; take turns
+    with open(os.path.join(SOCKET_DIR, f"{uid}.lock"), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            st = os.lstat(socket_path)
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(st.st_mode):
+                raise OSError(f"{socket_path} exists and is not a socket")
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chown(socket_path, uid, -1)
+        server.listen(1)
+
+        try:
+            conn, _ = server.accept()
+        finally:
+            server.close()
+            os.unlink(socket_path)
+
+    # Only the user who asked for the helper may talk to it
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, peer_uid, _ = struct.unpack('3i', creds)
+    if peer_uid not in (uid, 0):
+        conn.close()
+        return 1
+
+    write_lock = threading.Lock()
+
+    def respond(request):
+        response = handle(request, home)
+        data = (json.dumps(response) + '\n').encode()
+        with write_lock:
+            try:
+                conn.sendall(data)
+            except OSError:
+                pass
+
+    with conn, conn.makefile('rb') as reader:
+        for line in reader:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(request, dict):
+                continue
+            threading.Thread(target=respond, args=(request,), daemon=True).start()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("smb_mount_helper must run as root", file=sys.stderr)
+        return 1
+    try:
+        uid = int(os.environ['SUDO_UID'])
+    except (KeyError, ValueError):
+        print("smb_mount_helper must be started through sudo", file=sys.stderr)
+        return 1
+    try:
+        return serve(uid)
+    except OSError as e:
+        print(f"smb_mount_helper: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())